@@ -15,42 +15,619 @@
 
 import os
 import sys
+import gzip
+import io
+import csv
+import re
 import json
 import time
-import socket
+import codecs
+import queue
+import select
+import random
+import shutil
+import signal
+import hashlib
+import tempfile
+import threading
 import getpass
 import requests
 import datetime
 import argparse
 import subprocess
+import concurrent.futures
+from contextlib import contextmanager
+
+# Timed spans for the stages of a payout and every http call and wallet command.  A copy of
+# Tracer in MWGP_earningsEstimate.py (see README.md), with begin()/end() for the stages
+class Payout_Tracer:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+        self.lock = threading.Lock()
+        self.stages = threading.local()  # The open stage of each thread, see begin()
+
+    # Time a block, yields the span's args so the caller can add status, bytes, ...
+    @contextmanager
+    def span(self, name, category, **args):
+        if not self.enabled:
+            yield args
+            return
+        start = time.time()
+        start_counter = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, category, start, time.perf_counter() - start_counter, args)
+
+    # Start a span that ends with end(), for the stages reported by print_progress()
+    def begin(self, name, category):
+        if not self.enabled:
+            return
+        self.end()
+        self.stages.current = (name, category, time.time(), time.perf_counter())
+
+    def end(self, **args):
+        stage = getattr(self.stages, "current", None)
+        if stage is None:
+            return
+        self.stages.current = None
+        name, category, start, start_counter = stage
+        self.add(name, category, start, time.perf_counter() - start_counter, args)
+
+    def add(self, name, category, start, duration, args):
+        span = {"name": name, "cat": category, "start": start, "dur": duration, "tid": threading.get_ident(), "args": args}
+        with self.lock:
+            self.spans.append(span)
+
+    # Record the status and size of an http response in a span's args
+    def response(self, args, r):
+        args["status"] = r.status_code
+        args["bytes"] = len(r.content)
+
+    def write(self, filename, format="jsonl"):
+        with open(filename, "w") as tracefile:
+            if format == "chrome":
+                pid = os.getpid()
+                events = [{"name": span["name"], "cat": span["cat"], "ph": "X", "ts": span["start"]*1000000,
+                           "dur": span["dur"]*1000000, "pid": pid, "tid": span["tid"], "args": span["args"]}
+                          for span in self.spans]
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, tracefile)
+            else:
+                for span in self.spans:
+                    tracefile.write(json.dumps(span) + "\n")
+
+    def print_profile(self, out):
+        rows = {}
+        for span in self.spans:
+            row = rows.setdefault((span["cat"], span["name"]), [0, 0.0, 0.0, 0])
+            row[0] += 1
+            row[1] += span["dur"]
+            row[2] = max(row[2], span["dur"])
+            row[3] += span["args"].get("bytes", 0)
+        print(" ", file=out)
+        print("   {:<8} {:<48} {:>7} {:>11} {:>10} {:>10} {:>12}".format("Type", "Span", "Count", "Total (ms)", "Mean (ms)", "Max (ms)", "Bytes"), file=out)
+        for (category, name), (count, total, longest, size) in sorted(rows.items(), key=lambda item: -item[1][1]):
+            print("   {:<8} {:<48} {:>7} {:>11.1f} {:>10.2f} {:>10.2f} {:>12}".format(
+                    category, name[:48], count, total*1000, total*1000/count, longest*1000, size), file=out)
+        print(" ", file=out)
+
+# A requests timeout (seconds, or a (connect, read) tuple, or None) cut to at most seconds
+def cap_timeout(timeout, seconds):
+    if timeout is None:
+        return seconds
+    if isinstance(timeout, tuple):
+        return tuple(min(value, seconds) for value in timeout)
+    return min(timeout, seconds)
+
+# Keep-alive session for the pool API.  Every call gets a timeout, and idempotent
+# calls are retried with jittered exponential backoff on connection errors and
+# transient server errors.  Payment requests (POST) are never retried
+class Pool_API_Session:
+    idempotent_methods = ("GET", "HEAD")
+    retry_statuses = (429, 502, 503, 504)
+
+    def __init__(self, timeout=60, retries=3, backoff=0.5, tracer=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # time.time() after which no retry is started, or None
+        self.deadline = None
+        self.tracer = Payout_Tracer() if tracer is None else tracer
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempts = 1
+        if method in self.idempotent_methods:
+            attempts += self.retries
+        # The user id and anything after it are left out of the span name, so the profile
+        # groups by endpoint
+        path = re.sub(r"^\w+://[^/]*", "", url)
+        name = "{} {}".format(method, re.sub(r"/\d+(/.*)?$", "/N", path))
+        for attempt in range(attempts):
+            if attempt > 0 and self.deadline is not None:
+                kwargs["timeout"] = cap_timeout(kwargs["timeout"], self.deadline - time.time())
+            error = None
+            try:
+                with self.tracer.span(name, "http", attempt=attempt+1) as span:
+                    r = self.session.request(method, url, **kwargs)
+                    self.tracer.response(span, r)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt == attempts-1:
+                    raise
+                error = e
+            else:
+                if r.status_code not in self.retry_statuses or attempt == attempts-1:
+                    return r
+            pause = random.uniform(0, self.backoff * 2**attempt)
+            if self.deadline is not None and time.time() + pause >= self.deadline:
+                # No time left for another try
+                if error is not None:
+                    raise error
+                return r
+            time.sleep(pause)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+class Tape_Miss(Exception):
+    pass
+
+# Pool API tape, the same file format as APITape in MWGP_earningsEstimate.py (see README.md).
+# When recording, requests are made with http (a Pool_API_Session, or the requests module)
+class Tape_Response:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+class Pool_API_Tape:
+    def __init__(self, filename, mode, http=requests):
+        if mode not in ("record", "replay"):
+            raise ValueError("Unknown tape mode: {}".format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.http = http
+        self.lock = threading.Lock()
+        self.index = {}
+        # The same entries by method and url only.  A wallet signs with fresh nonces, so a
+        # replayed run returns a signed slate that differs from the recorded one
+        self.urls = {}
+        if mode == "record":
+            self.tapefile = gzip.open(filename, "wt", encoding="utf-8")
+            return
+        self.tapefile = None
+        with gzip.open(filename, "rt", encoding="utf-8") as tapefile:
+            for line in tapefile:
+                entry = json.loads(line)
+                key = (entry["method"], entry["url"], entry["body"])
+                self.index.setdefault(key, []).append(entry)
+                self.urls.setdefault(key[:2], []).append(entry)
+
+    def key(self, method, url, data):
+        if data is None:
+            body = None
+        else:
+            if not isinstance(data, bytes):
+                data = str(data).encode("utf-8")
+            body = hashlib.sha1(data).hexdigest()
+        return (method, url, body)
+
+    def request(self, method, url, data=None, **kwargs):
+        key = self.key(method, url, data)
+        if self.mode == "replay":
+            with self.lock:
+                entries = self.index.get(key) or self.urls.get(key[:2])
+                if not entries:
+                    raise Tape_Miss("No recorded response for {} {}".format(method, url))
+                # Keep serving the last response once the recorded ones are used up
+                entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            return Tape_Response(entry["status"], entry["text"])
+        r = self.http.request(method, url, data=data, **kwargs)
+        entry = {"method": key[0], "url": key[1], "body": key[2], "status": r.status_code, "text": r.text}
+        with self.lock:
+            self.tapefile.write(json.dumps(entry) + "\n")
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        if self.tapefile is not None:
+            self.tapefile.close()
+            self.tapefile = None
+        if self.http is not requests:
+            self.http.close()
+
+# Journal of one account's payout in progress, so that a rerun after a crash or timeout
+# resumes at the step that failed instead of requesting another slate or signing again.
+# Steps: "requested" (holds the unsigned slate), "signed" (also holds the signed slate).
+# The journal is removed once the signed slate is returned.  Every step is written to a
+# temporary file and renamed into place.  With no filename the journal is kept in memory only
+class Payout_Journal:
+    def __init__(self, filename):
+        self.filename = filename
+        self.entry = None
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as journalfile:
+                self.entry = json.load(journalfile)
+
+    def step(self):
+        if self.entry is None:
+            return None
+        return self.entry["step"]
+
+    def record(self, step, **values):
+        entry = dict(self.entry or {})
+        entry.update(values)
+        entry["step"] = step
+        entry["time"] = time.time()
+        if self.filename is None:
+            self.entry = entry
+            return
+        tmpfile = self.filename + ".tmp"
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as journalfile:
+            json.dump(entry, journalfile)
+            journalfile.flush()
+            os.fsync(journalfile.fileno())
+        os.replace(tmpfile, self.filename)
+        self.entry = entry
+
+    def clear(self):
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.entry = None
+
+# Grin++ wallet owner API client.  There is one client per wallet url in the process, with
+# one keep-alive connection pool, so batch and daemon runs share it.  Logging in decrypts the
+# wallet seed, so session tokens are kept in memory (never on disk) for ttl seconds and reused.
+# They are cached by user and a salted digest of the password, so a wrong password never gets
+# a cached session
+class Grinplusplus_Client:
+    clients = {}
+    clients_lock = threading.Lock()
+
+    def __init__(self, url, tracer):
+        self.url = url
+        self.tracer = tracer
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=8)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.salt = os.urandom(16)
+        self.tokens = {}  # key -> (session token, expiry time)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, url, tracer):
+        with cls.clients_lock:
+            if url not in cls.clients:
+                cls.clients[url] = Grinplusplus_Client(url, tracer)
+            return cls.clients[url]
+
+    # Log out of every cached session and close the connections of all clients
+    @classmethod
+    def close_all(cls):
+        with cls.clients_lock:
+            clients = list(cls.clients.values())
+            cls.clients = {}
+        for client in clients:
+            client.close()
+
+    def key(self, username, password):
+        return (username, hashlib.sha256(self.salt + str(password).encode("utf-8")).hexdigest())
+
+    # A cached session token that has not expired, or None
+    def cached_token(self, username, password):
+        key = self.key(username, password)
+        with self.lock:
+            entry = self.tokens.get(key)
+            if entry is None:
+                return None
+            if entry[1] > time.time():
+                return entry[0]
+            del self.tokens[key]
+        try:
+            self.request("logout", "POST", "/v1/wallet/owner/logout", entry[0])
+        except requests.exceptions.RequestException:
+            pass
+        return None
+
+    def forget(self, username, password):
+        with self.lock:
+            self.tokens.pop(self.key(username, password), None)
+
+    def request(self, name, method, path, token=None, headers=None, **kwargs):
+        kwargs.setdefault("timeout", 60)
+        headers = dict(headers or {})
+        if token is not None:
+            headers["session_token"] = token
+        with self.tracer.span("grin++ " + name, "http") as span:
+            r = self.session.request(method, self.url + path, headers=headers, **kwargs)
+            self.tracer.response(span, r)
+        return r
+
+    # Wallet status, the cheap call used to check the wallet (and a session token) is good
+    def status(self, token=None, timeout=60):
+        return self.request("retrieve_summary_info", "GET", "/v1/wallet/owner/retrieve_summary_info", token, timeout=timeout)
+
+    def login(self, username, password, ttl, timeout=60):
+        r = self.request("login", "POST", "/v1/wallet/owner/login", headers={"username": username, "password": password}, timeout=timeout)
+        if r.status_code == 200:
+            with self.lock:
+                self.tokens[self.key(username, password)] = (r.json()["session_token"], time.time() + ttl)
+        return r
+
+    def logout(self, token, timeout=60):
+        with self.lock:
+            for key, entry in list(self.tokens.items()):
+                if entry[0] == token:
+                    del self.tokens[key]
+        return self.request("logout", "POST", "/v1/wallet/owner/logout", token, timeout=timeout)
+
+    def receive_tx(self, token, slate, timeout=60):
+        return self.request("receive_tx", "POST", "/v1/wallet/owner/receive_tx", token, data='{ "slate": ' + slate + '}', timeout=timeout)
+
+    def close(self):
+        with self.lock:
+            tokens = [entry[0] for entry in self.tokens.values()]
+            self.tokens = {}
+        for token in tokens:
+            try:
+                self.request("logout", "POST", "/v1/wallet/owner/logout", token)
+            except requests.exceptions.RequestException:
+                pass
+        self.session.close()
+
+class Prompt_Timeout(Exception):
+    pass
+
+# Buffered reader for an interactive subprocess: reads its output in chunks as it
+# arrives and waits, with a deadline, for one of a set of prompts to appear.  Pipes can
+# not be select()ed on Windows, so there a thread reads them into a queue instead
+class Prompt_Reader:
+    def __init__(self, stream):
+        self.fd = stream.fileno()
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        self.searched = 0  # Buffer offset already searched for prompts
+        self.eof = False
+        self.chunks = None
+        if os.name != "posix":
+            self.chunks = queue.Queue()
+            threading.Thread(target=self.read_pipe, daemon=True).start()
+
+    # Non-posix: read the pipe until it closes, an empty chunk marks the end
+    def read_pipe(self):
+        while True:
+            try:
+                chunk = os.read(self.fd, 4096)
+            except OSError:
+                chunk = b""
+            self.chunks.put(chunk)
+            if len(chunk) == 0:
+                return
+
+    # Read the output that is available, waiting up to timeout seconds for some
+    def read_chunk(self, timeout):
+        if self.chunks is not None:
+            try:
+                chunk = self.chunks.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                return
+        else:
+            ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+            if len(ready) == 0:
+                return
+            chunk = os.read(self.fd, 4096)
+        if len(chunk) == 0:
+            self.eof = True
+            self.buffer += self.decoder.decode(b"", final=True)
+            return
+        self.buffer += self.decoder.decode(chunk)
+
+    # Wait for the first of the prompts to appear in the output.  Returns the prompt found and
+    # the output up to and including it, or (None, output) if the process closed its output.
+    # Raises Prompt_Timeout if no prompt appears within timeout seconds
+    def expect(self, prompts, timeout):
+        deadline = time.time() + timeout
+        longest = max(len(prompt) for prompt in prompts)
+        while True:
+            found = None
+            for prompt in prompts:
+                position = self.buffer.find(prompt, self.searched)
+                if position >= 0 and (found is None or position < found[1]):
+                    found = (prompt, position)
+            if found is not None:
+                end = found[1] + len(found[0])
+                output = self.buffer[:end]
+                self.buffer = self.buffer[end:]
+                self.searched = 0
+                return found[0], output
+            if self.eof:
+                output = self.buffer
+                self.buffer = ""
+                return None, output
+            # Only search the new output next time (less a prompt length, for a prompt split across reads)
+            self.searched = max(len(self.buffer) - longest + 1, 0)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Prompt_Timeout("Timed out waiting for {}, got: {}".format(" or ".join(prompts), self.buffer[-200:]))
+            self.read_chunk(remaining)
+
+# One running wallet713 process: started (in cwd, if given) and unlocked once, then used
+# for any number of commands, then asked to exit.  Each prompt is waited for up to timeout
+# seconds, and never past deadline (a time.time()) if one is given
+class Wallet713_Session:
+    def __init__(self, cmd, password, timeout, tracer=None, deadline=None, cwd=None):
+        self.cmd = cmd
+        self.password = password
+        self.timeout = timeout
+        self.deadline = deadline
+        self.cwd = cwd
+        self.tracer = Payout_Tracer() if tracer is None else tracer
+        self.handle = None
+        self.reader = None
+
+    # Start wallet713, unlock the wallet and wait for its command prompt.
+    # Returns an error message on failure
+    def open(self):
+        with self.tracer.span("wallet713 start", "wallet"):
+            return self.start()
+
+    def start(self):
+        self.handle = subprocess.Popen(self.cmd,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       cwd=self.cwd,
+                                       bufsize=0)
+        self.reader = Prompt_Reader(self.handle.stdout)
+        prompt, output = self.reader.expect(["Password:", ">"], self.wait_time())
+        if 'new wallet' in output:
+            return "You must initialize your wallet first"
+        if prompt is None:
+            return "Wallet test failed with output: {}".format(output)
+        if prompt == "Password:":
+            password = self.password + '\n'
+            self.handle.stdin.write(password.encode())
+            prompt, output = self.reader.expect(["wallet713>"], self.wait_time())
+            if prompt is None:
+                output += self.handle.stdout.read().decode("utf-8")
+                return "Wallet test failed with output: {}".format(output)
+
+    def is_open(self):
+        return self.handle is not None and self.handle.poll() is None
+
+    # Seconds to wait for the next prompt
+    def wait_time(self):
+        if self.deadline is None:
+            return self.timeout
+        return min(self.timeout, self.deadline - time.time())
+
+    # Run a wallet713 command, return its output and whether the wallet is still at its prompt
+    def command(self, command):
+        with self.tracer.span("wallet713 " + command.split(" ")[0], "wallet") as span:
+            self.handle.stdin.write((command + "\n").encode())
+            prompt, output = self.reader.expect(["wallet713>"], self.wait_time())
+            span["bytes"] = len(output)
+        return output, prompt is not None
+
+    # Ask wallet713 to exit, kill it if it does not.  Returns True if it exited cleanly
+    def close(self):
+        if self.handle is None:
+            return True
+        try:
+            if self.handle.poll() is None:
+                self.handle.stdin.write("exit\n".encode())
+            self.handle.wait(timeout=5)
+            return True
+        except Exception as e:
+            self.kill()
+            return False
+
+    # Kill wallet713 and return anything it wrote to stderr
+    def kill(self):
+        if self.handle is None:
+            return ""
+        if self.handle.poll() is None:
+            self.handle.kill()
+            self.handle.wait()
+        return self.handle.stderr.read().decode("utf-8")
+
+# Raised by error_exit() in batch mode, where one account's error must not exit the process
+class Payout_Error(Exception):
+    pass
+
+# Raised by Pool_Payout.time_left() when the --deadline has run out
+class Deadline_Exceeded(Exception):
+    pass
+
+# Resolve a credential reference from an accounts file: "env:NAME" reads an environment
+# variable, "file:path" reads the first line of a file, anything else is used as is
+def resolve_secret(ref):
+    if ref is None or ref == "":
+        return None
+    if ref.startswith("env:"):
+        value = os.environ.get(ref[4:])
+        if value is None:
+            raise ValueError("Environment variable {} is not set".format(ref[4:]))
+        return value
+    if ref.startswith("file:"):
+        with open(os.path.expanduser(ref[5:])) as secretfile:
+            return secretfile.readline().rstrip("\r\n")
+    return ref
 
 class Pool_Payout:
-    def __init__(self):
+    # Batch accounts file columns, and the ones that hold a credential reference
+    batch_columns = ["pool_user", "pool_pass", "payout_method", "wallet_user", "wallet_pass", "wallet_url",
+                     "wallet_api_url", "wallet_foreign_url", "wallet_api_secret", "wallet_dir"]
+    batch_secrets = ["pool_pass", "wallet_pass"]
+    # What each payout method would otherwise prompt for
+    batch_required = {
+        "Grin Wallet": ["wallet_pass"],
+        "BitGrin Wallet": ["wallet_pass"],
+        "Wallet713": ["wallet_pass"],
+        "Grin++ Wallet": ["wallet_user", "wallet_pass"],
+        "http/https": ["wallet_url"],
+    }
+    # Payout methods that run a wallet command, which must not run twice at once on one wallet
+    cli_wallet_methods = ["Grin Wallet", "BitGrin Wallet", "Wallet713"]
+
+    def __init__(self, tracer=None):
         self.version = "2.0.1"
         self.POOL_MINIMUM_PAYOUT = 0.1
         self.payout_method = None
         # Calculate the pool name and API url
         script = os.path.basename(__file__)
         if script.startswith("MWGP"):
-            self.payout_methods = ["Grin Wallet", "Grin++ Wallet", "Wallet713", "Slate Files", "http/https"]
+            self.payout_methods = ["Grin Wallet", "Grin++ Wallet", "Wallet713", "Slate Files", "http/https", "Grin Wallet API"]
             self.poolname = "MWGrinPool"
             self.walletprefix = "grin"
             self.mwURL = "https://api.mwgrinpool.com"
             self.walletflags = None
+            self.wallet_api_ports = (3420, 3415)
+            self.wallet_api_secret = "~/.grin/main/.owner_api_secret"
         elif script.startswith("BGP"):
             self.payout_methods = ["BitGrin Wallet", "Slate Files", "http/https"]
             self.poolname = "BitGrinPool"
             self.walletprefix = "bitgrin"
             self.mwURL = "https://api.pool.bitgrin.dev"
             self.walletflags = None
+            self.wallet_api_ports = (3420, 3415)
+            self.wallet_api_secret = "~/.bitgrin/main/.owner_api_secret"
         elif script.startswith("MWFP"):
-            self.payout_methods = ["Grin Wallet", "Wallet713", "Slate Files", "http/https"]
+            self.payout_methods = ["Grin Wallet", "Wallet713", "Slate Files", "http/https", "Grin Wallet API"]
             self.poolname = "MWFlooPool"
             self.walletprefix = "grin"
             self.mwURL = "https://api.mwfloopool.com"
             self.walletflags = "--floonet"
+            self.wallet_api_ports = (13420, 13415)
+            self.wallet_api_secret = "~/.grin/floo/.owner_api_secret"
         self.unsigned_slatefile = "payment_slate.json"
         self.signed_slatefile = "payment_slate.json.response"
+        # With slate_files False the slate is kept in memory, and wallets that can only
+        # read a file get one in the private slate_dir
+        self.slate_files = True
+        self.slate_dir = None
         self.args = None
         self.prompted = False
         self.username = None
@@ -59,74 +636,163 @@ class Pool_Payout:
         self.user_id = None
         self.wallet_cmd = None
         self.wallet713_cmd = None
+        # The payout profile in use (see load_profile()), and wallets found by searching this run
+        self.profile = None
+        self.found_wallets = {}
+        self.secret_refs = {}
+        self.wallet713_timeout = 120  # Max seconds to wait for wallet713 to respond
+        self.wallet713_session = None
         self.balance = 0.0
         self.unsigned_slate = None
         self.signed_slate = None
         self.wallet_user = None
         self.wallet_session_token = None
+        # Grin++ owner API client, shared by every payout in the process
+        self.grinplusplus = None
+        self.grinplusplus_url = "http://localhost:3420"
+        self.grinplusplus_token_ttl = 900  # Seconds a Grin++ session token is reused for
         self.wallet_url = None
+        self.wallet_owner_url = None
+        self.wallet_foreign_url = None
+        self.wallet_api_auth = None
+        # Keep-alive connection to the grin-wallet owner and foreign APIs
+        self.wallet_http = None
+        # Background pool account lookup, see start_pool_account_lookup()
+        self.pool_lookup = None
+        # Batch mode: a lock for each wallet that accounts share, see batch_wallet_lock()
+        self.wallet_locks = {}
+        self.wallet_locks_lock = threading.Lock()
+        # All output goes to out.  In batch mode each account writes to its own buffer, and
+        # error_exit() raises Payout_Error instead of exiting
+        self.out = sys.stdout
+        self.batch = False
+        # Payout_Journal of the payment in progress, for the wallet payout methods
+        self.journal = None
+        # Daemon mode: a payout that was requested but not seen to leave the balance is
+        # retried after this many seconds
+        self.daemon_pending_timeout = 3600
+        self.pool_lookup_thread = None
+        # Pool API calls go through pool_http: a Pool_API_Session, or a Pool_API_Tape wrapping it
+        self.pool_timeout = (10, 60)  # Connect, read seconds
+        # --deadline: the time.time() the payout must be done by, and the seconds of it kept
+        # back for the final payment request.  See time_left()
+        self.deadline = None
+        self.deadline_reserve = 0.0
+        self.deadline_limit = None  # The limit the latest call was held to
+        self.stage = None  # The latest print_progress() message, to name in a deadline error
+        self.tracer = Payout_Tracer() if tracer is None else tracer
+        self.pool_http = Pool_API_Session(timeout=self.pool_timeout, tracer=self.tracer)
 
        
     # Print Indented
     def print_indent(self, message="", indent_level=1, newline=True):
         for index in range(0, indent_level):
-            sys.stdout.write("   ")
-        sys.stdout.write(message)
+            self.out.write("   ")
+        self.out.write(message)
         if newline is True:
-            sys.stdout.write("\n")
-        sys.stdout.flush()
+            self.out.write("\n")
+        self.out.flush()
 
     # Print tool head banner
     def print_banner(self):
-        print(" ")
-        print("#############  {} Payout Request Script: Version {}  #############".format(self.poolname, self.version))
-        print("## Started: {} ".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M")))
-        print("## ")
+        print(" ", file=self.out)
+        print("#############  {} Payout Request Script: Version {}  #############".format(self.poolname, self.version), file=self.out)
+        print("## Started: {} ".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M")), file=self.out)
+        print("## ", file=self.out)
 
     # Print tool footer
     def print_footer(self):
-        print("## ")
-        print("## Complete: {} ".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M")))
-        print("############# {} Payout Request Complete #############".format(self.poolname))
-        print(" ")
+        self.report_trace()
+        print("## ", file=self.out)
+        print("## Complete: {} ".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M")), file=self.out)
+        print("############# {} Payout Request Complete #############".format(self.poolname), file=self.out)
+        print(" ", file=self.out)
+
+    # Print the --profile summary and write the --trace file
+    def report_trace(self):
+        if not self.tracer.enabled or self.batch:
+            return
+        if self.args.profile:
+            self.tracer.print_profile(self.out)
+        if self.args.trace is not None:
+            try:
+                self.tracer.write(self.args.trace, self.args.trace_format)
+                self.print_indent("Trace written to: {}".format(self.args.trace))
+            except OSError as e:
+                self.print_indent("Could not write trace file: {}".format(str(e)))
 
     # Print progress message
     def print_progress(self, message):
-        sys.stdout.write("   ... {}:  ".format(message))
-        sys.stdout.flush()
+        self.stage = message
+        self.tracer.begin(message, "stage")
+        self.out.write("   ... {}:  ".format(message))
+        self.out.flush()
 
     # Print success message
     def print_success(self, message=None):
+        self.tracer.end()
         if message is None:
-            sys.stdout.write("Ok\n")
+            self.out.write("Ok\n")
         else:
             message = str(message)
-            sys.stdout.write(message)
+            self.out.write(message)
             if not message.endswith("\n"):
-                sys.stdout.write("\n")
-        sys.stdout.flush()
+                self.out.write("\n")
+        self.out.flush()
     # Print an error message, footer, and exit
     def error_exit(self, message):
         self.error(message, True)
 
     # Print an error message, optionally print footer, and exit
     def error(self, message, exit=False):
-        print(" ")
-        print(" ")
-        print("   *** Error: {}".format(message))
+        if exit == True and self.out_of_time():
+            message = "The --deadline of {}s ran out at stage \"{}\": {}".format(self.args.deadline, self.stage or "Starting", message)
+        print(" ", file=self.out)
+        print(" ", file=self.out)
+        print("   *** Error: {}".format(message), file=self.out)
         if exit == True:
+            self.tracer.end(error=str(message))
+            if self.batch:
+                raise Payout_Error(message)
             self.print_footer()
             sys.exit(1)
 
+    # Start the --deadline clock.  A fifth of it, up to 10 seconds, is kept back for the
+    # final payment request, so a slow wallet can not leave a signed slate unreturned
+    def start_deadline(self):
+        if self.args.deadline is None:
+            return
+        if self.args.deadline <= 0:
+            self.error_exit("--deadline must be more than 0 seconds")
+        self.deadline = time.time() + self.args.deadline
+        self.deadline_reserve = min(self.args.deadline / 5.0, 10.0)
+        self.pool_http.deadline = self.deadline - self.deadline_reserve
+
+    # The timeout for the next network call or subprocess: timeout, cut to the time left
+    # before the --deadline (less the reserve, unless this is the final payment request).
+    # Raises Deadline_Exceeded if there is no time left
+    def time_left(self, timeout, final=False):
+        if self.deadline is None:
+            return timeout
+        self.deadline_limit = self.deadline if final else self.deadline - self.deadline_reserve
+        left = self.deadline_limit - time.time()
+        if left <= 0:
+            raise Deadline_Exceeded("No time left for the next call")
+        return cap_timeout(timeout, left)
+
+    # True if the time limit of the latest call has passed, so that is why it failed
+    def out_of_time(self):
+        return self.deadline_limit is not None and time.time() >= self.deadline_limit
+
     # Print menu, prompt for selection
     def prompt_menu(self, message, options, default):
         ok = False
         while ok == False:
-            print(" ")
+            print(" ", file=self.out)
             self.print_indent(message)
             for key, value in options.items():
                 self.print_indent("{}. {}".format(key, value))
-            print(" ")
+            print(" ", file=self.out)
             self.print_indent("Choice [{}]".format(default), 1, False)
             selection = input(" ")
             if selection == "":
@@ -139,32 +805,46 @@ class Pool_Payout:
         
     # Delete any existing slate and slate response
     def clean_slate_files(self):
+        if not self.slate_files and self.slate_dir is None:
+            return
         for slatefile in [self.unsigned_slatefile, self.signed_slatefile]:
             if os.path.exists(slatefile):
                 os.remove(slatefile)
 
+    # Keep the slate files a wallet CLI needs in a private directory, on tmpfs when
+    # available, so they never touch the disk or the current directory
+    def use_private_slate_dir(self):
+        base = None
+        if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            base = "/dev/shm"
+        self.slate_dir = tempfile.mkdtemp(prefix="payment-slate-", dir=base)
+        self.unsigned_slatefile = os.path.join(self.slate_dir, "payment_slate.json")
+        self.signed_slatefile = self.unsigned_slatefile + ".response"
+
+    def remove_private_slate_dir(self):
+        if self.slate_dir is not None:
+            shutil.rmtree(self.slate_dir, ignore_errors=True)
+            self.slate_dir = None
+
     # Find the wallet executable, from the path, cwd, and build directories
     def find_grin_wallet(self):
         ##
         # Find Grin Wallet Command
-        grin_wallet_cmd = None
-        cwd = os.getcwd()
-        path = os.environ.get('PATH')
-        path_add = [
-            cwd,
-            cwd + "/{}-wallet".format(self.walletprefix),
-            cwd + "/{}-wallet/target/debug".format(self.walletprefix),
-            cwd + "/{}-wallet/target/release".format(self.walletprefix),
-            path,
-        ]
-        path = ":".join(path_add)
-        for directory in path.split(":"):
-            if os.path.isfile(directory + "/{}-wallet".format(self.walletprefix)):
-                grin_wallet_cmd = [directory + "/{}-wallet".format(self.walletprefix)]
-            elif os.path.isfile(directory + "/{}-wallet.exe".format(self.walletprefix)):
-                grin_wallet_cmd = [directory + "/{}-wallet.exe".format(self.walletprefix)]
-        if grin_wallet_cmd is None:
-            return("Could not find wallet executable, please add it to your PATH or copy it into this directory.")
+        name = "{}-wallet".format(self.walletprefix)
+        wallet = self.cached_wallet(name)
+        if wallet is None:
+            cwd = os.getcwd()
+            directories = [
+                cwd,
+                cwd + "/{}-wallet".format(self.walletprefix),
+                cwd + "/{}-wallet/target/debug".format(self.walletprefix),
+                cwd + "/{}-wallet/target/release".format(self.walletprefix),
+            ] + os.environ.get('PATH', "").split(os.pathsep)
+            wallet = self.find_executable(name, directories)
+            if wallet is None:
+                return("Could not find wallet executable, please add it to your PATH or copy it into this directory.")
+            self.remember_wallet(name, wallet)
+        grin_wallet_cmd = [wallet]
 
         # Add any wallet flag
         if self.walletflags is not None:
@@ -172,23 +852,70 @@ class Pool_Payout:
 
         self.wallet_cmd = grin_wallet_cmd
 
+    # The last of the directories that has the executable name (or name.exe), or None.  Later
+    # directories take precedence, so the search runs from the end and stops at the first match
+    def find_executable(self, name, directories):
+        for directory in reversed(directories):
+            if directory == "":
+                continue
+            for filename in [name, name + ".exe"]:
+                candidate = os.path.join(directory, filename)
+                if os.path.isfile(candidate):
+                    return os.path.abspath(candidate)
+        return None
+
+    # The wallet executable saved in the payout profile, if it is the same file (same inode
+    # and modification time) as when it was found
+    def cached_wallet(self, name):
+        if self.profile is None:
+            return None
+        entry = self.profile.get("wallets", {}).get(name)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(entry["path"])
+        except (OSError, KeyError):
+            return None
+        if stat.st_ino != entry.get("inode") or stat.st_mtime != entry.get("mtime"):
+            return None
+        return entry["path"]
+
+    # Note a wallet executable found by searching, to save in the payout profile
+    def remember_wallet(self, name, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.found_wallets[name] = {"path": os.path.abspath(path), "inode": stat.st_ino, "mtime": stat.st_mtime}
+
+    # The directory to run the wallet command in (--wallet_dir), or None for the current directory
+    def wallet_cwd(self):
+        if self.args.wallet_dir is None:
+            return None
+        return os.path.expanduser(self.args.wallet_dir)
+
     def test_grin_wallet(self):
         ##
         # Sanity check the grin wallet executable and password
         wallettest_cmd = self.wallet_cmd + [ "-p", self.wallet_pass, "info" ]
+        timeout = self.time_left(None)
         try:
-            message = subprocess.check_output(wallettest_cmd, stderr=subprocess.STDOUT, shell=False)
+            with self.tracer.span("grin-wallet info", "wallet"):
+                message = subprocess.check_output(wallettest_cmd, stderr=subprocess.STDOUT, shell=False, timeout=timeout, cwd=self.wallet_cwd())
         except subprocess.CalledProcessError as exc:
             return "Wallet test failed with output: {}".format(exc.output.decode("utf-8"))
+        except subprocess.TimeoutExpired:
+            return "Wallet test timed out after {:.1f} seconds".format(timeout)
         except Exception as e:
             return "Wallet test failed with error {}".format(str(e))
 
     # Get my pool user_id
     def get_user_id(self):
         get_user_id_url = self.mwURL + "/pool/users"
-        r = requests.get(
+        r = self.pool_http.get(
                 url = get_user_id_url,
                 auth = (self.username, self.password),
+                timeout = self.time_left(self.pool_timeout),
         )
         message = None
         if r.status_code != 200:
@@ -200,9 +927,10 @@ class Pool_Payout:
     # Get the users balance
     def get_balance(self):
         get_user_balance = self.mwURL + "/worker/utxo/" + self.user_id
-        r = requests.get(
+        r = self.pool_http.get(
                 url = get_user_balance,
                 auth = (self.username, self.password),
+                timeout = self.time_left(self.pool_timeout),
         )
         if r.status_code != 200:
             return "Failed to get your account balance: {}".format(r.text)
@@ -218,14 +946,135 @@ class Pool_Payout:
         ##
         # Get the initial tx slate and write it to a file
         get_tx_slate_url = self.mwURL + "/pool/payment/get_tx_slate/" + self.user_id
-        r = requests.post(
+        r = self.pool_http.post(
                 url = get_tx_slate_url,
                 auth = (self.username, self.password),
+                timeout = self.time_left(self.pool_timeout),
         )
         if r.status_code != 200:
             return "Failed to get a payment slate: {}".format(r.text)
         self.unsigned_slate = r.text
 
+    # Look up the pool user id and then the balance in a background thread, so the
+    # lookups overlap with the wallet checks.  Nothing is printed until the join
+    def start_pool_account_lookup(self):
+        self.pool_lookup = {"user_id": None, "balance": None, "exception": None}
+        def lookup():
+            try:
+                self.pool_lookup["user_id"] = self.get_user_id()
+                if self.user_id is not None:
+                    self.pool_lookup["balance"] = self.get_balance()
+            except Exception as e:
+                self.pool_lookup["exception"] = e
+        self.pool_lookup_thread = threading.Thread(target=lookup, daemon=True)
+        self.pool_lookup_thread.start()
+
+    # Wait for the pool account lookup and report its results
+    def join_pool_account_lookup(self):
+        self.pool_lookup_thread.join()
+        self.pool_lookup_thread = None
+
+        # Find User ID.  A lookup exception is raised in the stage it happened in
+        self.print_progress("Getting your pool User ID");
+        if self.user_id is None and self.pool_lookup["exception"] is not None:
+            raise self.pool_lookup["exception"]
+        if self.user_id is None:
+            self.error_exit(self.pool_lookup["user_id"])
+        self.print_success()
+
+        # Find balance
+        self.print_progress("Getting your Avaiable Balance");
+        if self.pool_lookup["exception"] is not None:
+            raise self.pool_lookup["exception"]
+        if self.balance == None:
+            self.error_exit(self.pool_lookup["balance"])
+        self.print_success(self.balance)
+        # A resumed payment already holds its funds
+        if self.journal is not None and self.journal.step() is not None:
+            return
+        # Only continue if there are funds available
+        if self.balance < self.POOL_MINIMUM_PAYOUT:
+            self.error_exit("Insufficient Available Balance for payout: Minimum: {}, Available: {}".format(self.POOL_MINIMUM_PAYOUT, self.balance))
+
+    # Open this account's payout journal, and report a payment to resume
+    def open_journal(self):
+        # A replayed payment is not real, so a later live run must not resume it
+        if self.args.replay is not None:
+            self.journal = Payout_Journal(None)
+            return
+        user = re.sub(r"[^A-Za-z0-9._-]", "_", self.username)
+        filename = os.path.join(os.path.expanduser(self.args.journal_dir), "payout_journal-{}-{}.json".format(self.poolname, user))
+        try:
+            self.journal = Payout_Journal(filename)
+            if self.args.discard_journal:
+                self.journal.clear()
+        except (OSError, ValueError) as e:
+            self.error_exit("Could not read the payout journal {}: {}".format(filename, str(e)))
+        if self.journal.step() is not None:
+            self.print_indent("** Resuming the payment requested at {}, from: {}".format(
+                    datetime.datetime.fromtimestamp(self.journal.entry["time"]).strftime("%Y-%m-%d %H:%M"), filename))
+
+    # Read a slate response the wallet already wrote.  Returns True if there is one
+    def read_signed_slate_file(self):
+        try:
+            with open(self.signed_slatefile, 'r') as tx_slate_response:
+                content = tx_slate_response.read()
+            json.loads(content)
+        except (OSError, ValueError):
+            return False
+        self.signed_slate = content
+        return True
+
+    ##
+    # The steps all the wallet payout methods share once the wallet is ready: get a slate
+    # from the pool, have the wallet sign it, return it to the pool.  Each step is recorded
+    # in the journal, and a resumed payment starts after the last recorded step
+    def process_payment(self, sign_slate, slate_file):
+        step = self.journal.step()
+        try:
+            if step is None:
+                # Get payment slate from Pool
+                self.print_progress("Requesting a Payment from the pool");
+                message = self.get_unsigned_slate()
+                if self.unsigned_slate is None:
+                    self.error_exit(message)
+                self.journal.record("requested", method=self.payout_method, user_id=self.user_id, unsigned_slate=self.unsigned_slate)
+                self.print_success()
+            else:
+                self.unsigned_slate = self.journal.entry["unsigned_slate"]
+
+            if step == "signed":
+                self.signed_slate = self.journal.entry["signed_slate"]
+            else:
+                # Call the wallet to receive the slate and sign it
+                self.print_progress("Processing the payment with your wallet")
+                if step == "requested" and slate_file and self.read_signed_slate_file():
+                    # The wallet signed it before the last run stopped
+                    pass
+                else:
+                    if slate_file:
+                        message = self.write_unsigned_slate_file()
+                        if not os.path.isfile(self.unsigned_slatefile):
+                            self.error_exit(message)
+                    message = sign_slate()
+                    if message is not None:
+                        self.error_exit(message)
+                self.journal.record("signed", signed_slate=self.signed_slate)
+                self.print_success()
+        except OSError as e:
+            self.error_exit("Could not write the payout journal {}: {}".format(self.journal.filename, str(e)))
+
+        # Return the signed slate to the pool
+        self.print_progress("Returning the signed payment slate to the pool");
+        message = self.return_payment_slate()
+        if message is not None:
+            self.error_exit("{}.  Run again to retry, or with --discard_journal to start over".format(message))
+        self.journal.clear()
+        self.print_success()
+
+        # Cleanup
+        self.clean_slate_files()
+
     # Write json slate to a file
     def write_unsigned_slate_file(self):
         try:
@@ -254,51 +1103,120 @@ class Pool_Payout:
         recv_cmd = self.wallet_cmd + [
                 "-p", self.wallet_pass,
               "receive",
-                "-i", self.unsigned_slatefile,
+                "-i", os.path.abspath(self.unsigned_slatefile),
         ]
+        timeout = self.time_left(None)
         try:
-            output = subprocess.check_output(recv_cmd, stderr=subprocess.STDOUT, shell=False)
+            with self.tracer.span("grin-wallet receive", "wallet"):
+                output = subprocess.check_output(recv_cmd, stderr=subprocess.STDOUT, shell=False, timeout=timeout, cwd=self.wallet_cwd())
             with open(self.signed_slatefile, 'r') as tx_slate_response:
                 self.signed_slate = tx_slate_response.read()
         except subprocess.CalledProcessError as exc:
             return "Signing slate failed with output: {}".format(exc.output.decode("utf-8"))
+        except subprocess.TimeoutExpired:
+            return "Signing slate timed out after {:.1f} seconds".format(timeout)
         except Exception as e:
             return "Wallet receive failed with error: {}".format(str(e))
 
-    def test_grinplusplus_wallet(self):
+    # Call a grin-wallet v2 JSON-RPC API method, with basic auth if given.  Returns (result, error message)
+    def call_wallet_api(self, url, method, params, auth=None):
+        if self.wallet_http is None:
+            self.wallet_http = requests.Session()
+        request = {
+                "jsonrpc": "2.0",
+                "id": 1,
+                "method": method,
+                "params": params,
+            }
+        timeout = self.time_left(60)
+        try:
+            with self.tracer.span("wallet api " + method, "http") as span:
+                r = self.wallet_http.post(
+                        url = url,
+                        json = request,
+                        auth = auth,
+                        timeout = timeout,
+                )
+                self.tracer.response(span, r)
+        except Exception as e:
+            return None, "Could not connect to the wallet API at {}.  Is the wallet listener running?".format(url)
+        if r.status_code != 200:
+            return None, "Wallet API {} failed - {}: {}".format(method, r.status_code, r.text)
+        response = r.json()
+        if "error" in response:
+            return None, "Wallet API {} failed - {}".format(method, response["error"])
+        result = response.get("result")
+        if isinstance(result, dict) and "Err" in result:
+            return None, "Wallet API {} failed - {}".format(method, result["Err"])
+        if isinstance(result, dict) and "Ok" in result:
+            return result["Ok"], None
+        return result, None
+
+    def test_grin_wallet_api(self):
+        ##
+        # Check the wallet owner API is up and the wallet is open, without a
+        # refresh from the node so no outputs are scanned
+        secret_file = os.path.expanduser(self.wallet_api_secret)
+        if os.path.isfile(secret_file):
+            try:
+                with open(secret_file, "r") as f:
+                    self.wallet_api_auth = ("grin", f.read().strip())
+            except Exception as e:
+                return "Could not read the wallet API secret {}: {}".format(secret_file, str(e))
+        result, message = self.call_wallet_api(self.wallet_owner_url, "retrieve_summary_info", [False, 1], self.wallet_api_auth)
+        if message is not None:
+            return message
+
+    def sign_slate_with_wallet_api(self):
         ##
-        # Test that the grin++ wallet API is available
-        s = socket.socket()
-        s.settimeout(2)
+        # Ask the wallet foreign API listener to receive and sign the slate
         try:
-            s.connect(("localhost", 3420))
-            s.close()
+            slate = json.loads(self.unsigned_slate)
         except Exception as e:
+            return "Invalid payment slate from the pool: {}".format(str(e))
+        result, message = self.call_wallet_api(self.wallet_foreign_url, "receive_tx", [slate, None, None])
+        if message is not None:
+            return message
+        self.signed_slate = json.dumps(result)
+
+    def test_grinplusplus_wallet(self):
+        ##
+        # Test that the grin++ wallet API is available.  With a cached session this is an
+        # authenticated status call, otherwise an unauthenticated one that only needs an answer
+        self.grinplusplus = Grinplusplus_Client.get(self.grinplusplus_url, self.tracer)
+        self.wallet_session_token = self.grinplusplus.cached_token(self.wallet_user, self.wallet_pass)
+        try:
+            r = self.grinplusplus.status(self.wallet_session_token, timeout=self.time_left(60))
+        except requests.exceptions.RequestException as e:
             return "Could not connect to Grin++ wallet port.  Is the wallet running?"
+        if self.wallet_session_token is not None and r.status_code != 200:
+            # The wallet was restarted or logged out, log in again
+            self.grinplusplus.forget(self.wallet_user, self.wallet_pass)
+            self.wallet_session_token = None
 
     def login_grinplusplus_wallet(self):
         ##
-        # Log into Grin++ wallet and get a session token
-        login_url = "http://localhost:3420/v1/wallet/owner/login"
-        r = requests.post(
-                url = login_url,
-                headers = {
-                        "username": self.wallet_user,
-                        "password": self.wallet_pass,
-                    }
-            )
+        # Log into Grin++ wallet and get a session token, unless a cached one is still valid
+        if self.wallet_session_token is not None:
+            return None
+        try:
+            r = self.grinplusplus.login(self.wallet_user, self.wallet_pass, self.grinplusplus_token_ttl, timeout=self.time_left(60))
+        except requests.exceptions.RequestException as e:
+            return "Failed to log into wallet - {}".format(str(e))
         if r.status_code != 200:
             return "Failed to log into wallet - {}".format(r.text)
         self.wallet_session_token = r.json()["session_token"]
 
     def logout_grinplusplus_wallet(self):
         ##
-        # Log out of Grin++ wallet
-        login_url = "http://localhost:3420/v1/wallet/owner/logout"
-        r = requests.post(
-                url = login_url,
-                headers = { "session_token": self.wallet_session_token },
-            )
+        # Log out of Grin++ wallet.  Skipped if the --deadline has run out, the payment is
+        # done by now and the session expires on its own
+        if self.deadline is not None and time.time() >= self.deadline:
+            return None
+        try:
+            r = self.grinplusplus.logout(self.wallet_session_token, timeout=self.time_left(60, final=True))
+        except requests.exceptions.RequestException as e:
+            return "Failed to log out of wallet - {}".format(str(e))
         if r.status_code != 200:
             return "Failed to log out of wallet - {}".format(r.text)
         self.wallet_session_token = None
@@ -306,12 +1224,10 @@ class Pool_Payout:
     def sign_slate_with_grinplusplus_wallet_api(self):
         ##
         # Call Grin++ wallet API to sign the slate file
-        sign_slate_url = "http://localhost:3420/v1/wallet/owner/receive_tx"
-        r = requests.post(
-                url = sign_slate_url,
-                headers = { "session_token": self.wallet_session_token },
-                data = '{ "slate": ' + self.unsigned_slate + '}'
-            )
+        try:
+            r = self.grinplusplus.receive_tx(self.wallet_session_token, self.unsigned_slate, timeout=self.time_left(60))
+        except requests.exceptions.RequestException as e:
+            return "Failed to receive slate - {}".format(str(e))
         if r.status_code != 200:
             return "Failed to receive slate - {}".format(r.text)
         self.signed_slate = r.text
@@ -320,24 +1236,20 @@ class Pool_Payout:
     def find_wallet713(self):
         ##
         # Find wallet713 Command
-        wallet713_cmd = None
-        cwd = os.getcwd()
-        path = os.environ.get('PATH')
-        path_add = [
-            path,
-            cwd,
-            cwd + "/wallet713",
-            cwd + "/wallet713/target/debug",
-            cwd + "/wallet713/target/release",
-        ]
-        path = ":".join(path_add)
-        for directory in path.split(":"):
-            if os.path.isfile(directory + "/wallet713"):
-                wallet713_cmd = [directory + "/wallet713"]
-            elif os.path.isfile(directory + "/wallet713.exe"):
-                wallet713_cmd = [directory + "/wallet713.exe"]
-        if wallet713_cmd is None:
-            return("Could not find wallet713 executable, please add it to your PATH or copy it into this directory.")
+        wallet = self.cached_wallet("wallet713")
+        if wallet is None:
+            cwd = os.getcwd()
+            directories = os.environ.get('PATH', "").split(os.pathsep) + [
+                cwd,
+                cwd + "/wallet713",
+                cwd + "/wallet713/target/debug",
+                cwd + "/wallet713/target/release",
+            ]
+            wallet = self.find_executable("wallet713", directories)
+            if wallet is None:
+                return("Could not find wallet713 executable, please add it to your PATH or copy it into this directory.")
+            self.remember_wallet("wallet713", wallet)
+        wallet713_cmd = [wallet]
 
         # Add any wallet flag
         if self.walletflags is not None:
@@ -345,34 +1257,39 @@ class Pool_Payout:
 
         self.wallet713_cmd = wallet713_cmd
 
+    # Close the wallet713 session, if one is open
+    def close_wallet713(self):
+        if self.wallet713_session is None:
+            return True
+        exited = self.wallet713_session.close()
+        self.wallet713_session = None
+        return exited
+
     def test_wallet713(self):
         ##
-        # Sanity check the wallet713 executable and password
-        try:
-            w713_handle = subprocess.Popen(self.wallet713_cmd,
-                                           stdin=subprocess.PIPE,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE,
-                                           bufsize=0)
-            output = w713_handle.stdout.read(1).decode("utf-8")
-            while "Password:" not in output and output[-1] != ">":
-                output += w713_handle.stdout.read(1).decode("utf-8")
-            if 'new wallet' in output:
-                return("You must initialize your wallet first")
-            password = self.wallet_pass + '\n'
-            w713_handle.stdin.write(password.encode())
-            w713_handle.stdin.write("help\n".encode())
-            output = w713_handle.stdout.read(1).decode("utf-8")
-            while w713_handle.poll() is None and output[-10:] != 'wallet713>':
-                output += w713_handle.stdout.read(1).decode("utf-8")
-            if w713_handle.poll() is not None:
-                output += w713_handle.stdout.read().decode("utf-8")
+        # Sanity check the wallet713 executable and password.  The unlocked wallet is
+        # kept open to sign the slate with
+        self.close_wallet713()
+        left = self.time_left(None)
+        deadline = None if left is None else time.time() + left
+        session = Wallet713_Session(self.wallet713_cmd, self.wallet_pass, self.wallet713_timeout, self.tracer, deadline, self.wallet_cwd())
+        try:
+            message = session.open()
+            if message is not None:
+                session.close()
+                return message
+            output, ok = session.command("help")
+            if not ok:
+                session.close()
                 return("Wallet test failed with output: {}".format(output))
-            self.wallet713_cmd = self.wallet713_cmd
+            self.wallet713_session = session
         except PermissionError as e:
             return "Wallet test failed with output: {}".format(str(e))
+        except Prompt_Timeout as e:
+            session.kill()
+            return "Wallet test failed: {}".format(str(e))
         except Exception as e:
-            err = w713_handle.stderr.read().decode("utf-8")
+            err = session.kill()
             if "error" in err or "Error" in err:
                 return "Wallet test failed with: {}".format(err)
             else:
@@ -380,56 +1297,46 @@ class Pool_Payout:
 
     def sign_slate_with_wallet713_cli(self):
         ##
-        # Call the wallet713 command and use "expect"-like text processing to
+        # Use the wallet713 session and "expect"-like text processing to
         # sign the slate file
+        if self.wallet713_session is None or not self.wallet713_session.is_open():
+            message = self.test_wallet713()
+            if message is not None:
+                return message
+        session = self.wallet713_session
         try:
-            w713_handle = subprocess.Popen(self.wallet713_cmd,
-                                           stdin=subprocess.PIPE,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE,
-                                           bufsize=0)
-            output = w713_handle.stdout.read(1).decode("utf-8")
-            while "Password:" not in output and output[-1] != ">":
-                output += w713_handle.stdout.read(1).decode("utf-8")
-            if 'new wallet' in output:
-                return("You must initialize your wallet first")
-            password = self.wallet_pass + '\n'
-            w713_handle.stdin.write(password.encode())
-            receive_cmd = "receive {}\n".format(self.unsigned_slatefile)
-            w713_handle.stdin.write(receive_cmd.encode())
-            time.sleep(2)
-            output = w713_handle.stdout.read(1).decode("utf-8")
-            while w713_handle.poll() is None and output[-10:] != 'wallet713>':
-                output += w713_handle.stdout.read(1).decode("utf-8")
+            output, ok = session.command("receive {}".format(os.path.abspath(self.unsigned_slatefile)))
             for line in output.split("\n"):
                 if "Error" in line:
+                    self.close_wallet713()
                     err = line.split(' ', 1)
-                    return("Slate receive failed with: {}".format(err[1]))
-            w713_handle.stdin.write("exit\n".encode())
-            count = 0
-            while w713_handle.poll() is None and count < 50:
-                time.sleep(0.1)
-                count += 1
-            if count >= 50:
+                    return("Slate receive failed with: {}".format(err[-1]))
+            if not self.close_wallet713() or not ok:
                 return("Slate receive failed")
             with open(self.signed_slatefile, 'r') as tx_slate_response:
                 self.signed_slate = tx_slate_response.read()
+        except Prompt_Timeout as e:
+            session.kill()
+            return "Slate receive failed: {}".format(str(e))
         except Exception as e:
-            err = w713_handle.stderr.read().decode("utf-8")
+            err = session.kill()
             if "error" in err or "Error" in err:
                 return "Slate receive failed with error: {}".format(err)
             else:
                 return "Slate receive failed with error {}".format(str(e))
+        finally:
+            self.wallet713_session = None
 
 
     def return_payment_slate(self):
         ##
         # Submit the signed slate back to the pool to be finalized and posted to the network
         submit_tx_slate_url = self.mwURL + "/pool/payment/submit_tx_slate/" + self.user_id
-        r = requests.post(
+        r = self.pool_http.post(
                 url = submit_tx_slate_url,
                 data = self.signed_slate,
                 auth = (self.username, self.password),
+                timeout = self.time_left(self.pool_timeout, final=True),
         )
         if r.status_code != 200:
             return "Failed to submit signed slate - {}".format(r.text)
@@ -438,9 +1345,10 @@ class Pool_Payout:
         ##
         # Call the pool API to request a payment to http/https URL
         request_http_payment_url = self.mwURL + "/pool/payment/http/" + self.user_id + "/" + self.wallet_url
-        r = requests.post(
+        r = self.pool_http.post(
                 url = request_http_payment_url,
                 auth = (self.username, self.password),
+                timeout = self.time_left(self.pool_timeout, final=True),
         )
         if r.status_code != 200:
             return "Failed to make http payout - {}".format(r.text)
@@ -456,8 +1364,12 @@ class Pool_Payout:
             self.wallet_pass = self.args.wallet_pass
     
         # Cleanup
-        self.clean_slate_files()
+        if self.journal.step() is None:
+            self.clean_slate_files()
     
+        # Look up the pool account while the wallet is checked
+        self.start_pool_account_lookup()
+
         # Find wallet Command
         self.print_progress("Locating your grin wallet command");
         message = self.find_grin_wallet()
@@ -468,59 +1380,53 @@ class Pool_Payout:
             self.error_exit(message)
         self.print_success()
 
-	# Find User ID 
-        self.print_progress("Getting your pool User ID");
-        message = self.get_user_id()
-        if self.user_id is None:
-            self.error_exit(message)
-        self.print_success()
+        # Wait for the pool account lookup
+        self.join_pool_account_lookup()
 
-#        # Check for existing slates and ask if we should process it
-#        if os.path.exists(self.signed_slatefile):
-#            xxx
-    
-        # Find balance
-        self.print_progress("Getting your Avaiable Balance");
-        message = self.get_balance()
-        if self.balance == None:
-            self.error_exit(message)
-        self.print_success(self.balance)
-        # Only continue if there are funds available
-        if self.balance < self.POOL_MINIMUM_PAYOUT:
-            self.error_exit("Insufficient Available Balance for payout: Minimum: {}, Available: {}".format(self.POOL_MINIMUM_PAYOUT, self.balance))
+        # Request, sign and return the payment slate
+        self.process_payment(self.sign_slate_with_wallet_cli, True)
 
-        # Get payment slate from Pool
-        self.print_progress("Requesting a Payment from the pool");
-        message = self.get_unsigned_slate()
-        if self.unsigned_slate is None:
-            self.error_exit(message)
-        # Write the slate to file
-        message = self.write_unsigned_slate_file()
-        if not os.path.isfile(self.unsigned_slatefile):
-            self.error_exit(message)
-        self.print_success()
 
-        # Call grin wallet to receive the slate and sign it
-        self.print_progress("Processing the payment with your wallet")
-        message = self.sign_slate_with_wallet_cli()
-        if message is not None:
-            self.error_exit(message)
-        self.print_success()
+    ##
+    # Get Payout using a running grin-wallet owner API and foreign API listener
+    def run_grin_wallet_api(self):
+        if self.args.wallet_api_url is None:
+            self.wallet_owner_url = "http://127.0.0.1:{}/v2/owner".format(self.wallet_api_ports[0])
+        else:
+            self.wallet_owner_url = self.args.wallet_api_url
+        if self.args.wallet_foreign_url is None:
+            self.wallet_foreign_url = "http://127.0.0.1:{}/v2/foreign".format(self.wallet_api_ports[1])
+        else:
+            self.wallet_foreign_url = self.args.wallet_foreign_url
+        if self.args.wallet_api_secret is not None:
+            self.wallet_api_secret = self.args.wallet_api_secret
 
-        # Return the signed slate to the pool
-        self.print_progress("Returning the signed payment slate to the pool");
-        message = self.return_payment_slate()
+        # Look up the pool account while the wallet is checked
+        self.start_pool_account_lookup()
+
+        # Test Wallet API
+        self.print_progress("Testing your grin wallet API");
+        message = self.test_grin_wallet_api()
         if message is not None:
             self.error_exit(message)
         self.print_success()
 
-        # Cleanup
-        self.clean_slate_files()
+        # Wait for the pool account lookup
+        self.join_pool_account_lookup()
+
+        # Request, sign and return the payment slate
+        self.process_payment(self.sign_slate_with_wallet_api, False)
 
 
     ##
     # Get Payout using local wallet713
     def run_wallet713(self):
+        try:
+            self.run_wallet713_session()
+        finally:
+            self.close_wallet713()
+
+    def run_wallet713_session(self):
         if self.args.wallet_pass is None:
             self.wallet_pass = getpass.getpass("   Wallet Password: ")
             self.prompted = True
@@ -528,8 +1434,12 @@ class Pool_Payout:
             self.wallet_pass = self.args.wallet_pass
     
         # Cleanup
-        self.clean_slate_files()
+        if self.journal.step() is None:
+            self.clean_slate_files()
     
+        # Look up the pool account while the wallet is checked
+        self.start_pool_account_lookup()
+
         # Find wallet Command
         self.print_progress("Locating your wallet713 command");
         message = self.find_wallet713()
@@ -540,54 +1450,11 @@ class Pool_Payout:
             self.error_exit(message)
         self.print_success()
 
-	# Find User ID 
-        self.print_progress("Getting your pool User ID");
-        message = self.get_user_id()
-        if self.user_id is None:
-            self.error_exit(message)
-        self.print_success()
+        # Wait for the pool account lookup
+        self.join_pool_account_lookup()
 
-#        # Check for existing slates and ask if we should process it
-#        if os.path.exists(self.signed_slatefile):
-#            xxx
-    
-        # Find balance
-        self.print_progress("Getting your Avaiable Balance");
-        message = self.get_balance()
-        if self.balance == None:
-            self.error_exit(message)
-        self.print_success(self.balance)
-        # Only continue if there are funds available
-        if self.balance < self.POOL_MINIMUM_PAYOUT:
-            self.error_exit("Insufficient Available Balance for payout: Minimum: {}, Available: {}".format(self.POOL_MINIMUM_PAYOUT, self.balance))
-
-        # Get payment slate from Pool
-        self.print_progress("Requesting a Payment from the pool");
-        message = self.get_unsigned_slate()
-        if self.unsigned_slate is None:
-            self.error_exit(message)
-        # Write the slate to file
-        message = self.write_unsigned_slate_file()
-        if not os.path.isfile(self.unsigned_slatefile):
-            self.error_exit(message)
-        self.print_success()
-
-        # Call grin wallet to receive the slate and sign it
-        self.print_progress("Processing the payment with your wallet")
-        message = self.sign_slate_with_wallet713_cli()
-        if message is not None:
-            self.error_exit(message)
-        self.print_success()
-
-        # Return the signed slate to the pool
-        self.print_progress("Returning the signed payment slate to the pool");
-        message = self.return_payment_slate()
-        if message is not None:
-            self.error_exit(message)
-        self.print_success()
-
-        # Cleanup
-        self.clean_slate_files()
+        # Request, sign and return the payment slate
+        self.process_payment(self.sign_slate_with_wallet713_cli, True)
 
 
 
@@ -607,8 +1474,12 @@ class Pool_Payout:
             self.wallet_pass = self.args.wallet_pass
     
         # Cleanup
-        self.clean_slate_files()
+        if self.journal.step() is None:
+            self.clean_slate_files()
     
+        # Look up the pool account while the wallet is checked
+        self.start_pool_account_lookup()
+
         # Test Wallet API
         self.print_progress("Testing your Grin++ wallet API");
         message = self.test_grinplusplus_wallet()
@@ -623,61 +1494,20 @@ class Pool_Payout:
             self.error_exit(message)
         self.print_success()
 
-	# Find User ID 
-        self.print_progress("Getting your pool User ID");
-        message = self.get_user_id()
-        if self.user_id is None:
-            self.error_exit(message)
-        self.print_success()
-
-#        # Check for existing slates and ask if we should process it
-#        if os.path.exists(self.signed_slatefile):
-#            xxx
-    
-        # Find balance
-        self.print_progress("Getting your Avaiable Balance");
-        message = self.get_balance()
-        if self.balance == None:
-            self.error_exit(message)
-        self.print_success(self.balance)
-        # Only continue if there are funds available
-        if self.balance < self.POOL_MINIMUM_PAYOUT:
-            self.error_exit("Insufficient Available Balance for payout: Minimum: {}, Available: {}".format(self.POOL_MINIMUM_PAYOUT, self.balance))
+        # Wait for the pool account lookup
+        self.join_pool_account_lookup()
 
-        # Get payment slate from Pool
-        self.print_progress("Requesting a Payment from the pool");
-        message = self.get_unsigned_slate()
-        if self.unsigned_slate is None:
-            self.error_exit(message)
-        # Write the slate to file
-        message = self.write_unsigned_slate_file()
-        if not os.path.isfile(self.unsigned_slatefile):
-            self.error_exit(message)
-        self.print_success()
-
-        # Call Grin++ wallet to receive the slate and sign it
-        self.print_progress("Processing the payment with your wallet")
-        message = self.sign_slate_with_grinplusplus_wallet_api()
-        if message is not None:
-            self.error_exit(message)
-        self.print_success()
+        # Request, sign and return the payment slate
+        self.process_payment(self.sign_slate_with_grinplusplus_wallet_api, self.slate_files)
 
-        # Return the signed slate to the pool
-        self.print_progress("Returning the signed payment slate to the pool");
-        message = self.return_payment_slate()
-        if message is not None:
-            self.error_exit(message)
-        self.print_success()
-
-        # Cleanup
-        self.clean_slate_files()
-
-        # Log out of wallet
-        self.print_progress("Logging out of your Grin++ wallet");
-        message = self.logout_grinplusplus_wallet()
-        if message is not None:
-            self.error_exit(message)
-        self.print_success()
+        # Log out of wallet.  Batch and daemon runs keep the session for the next payout,
+        # and log out when they finish
+        if not self.batch:
+            self.print_progress("Logging out of your Grin++ wallet");
+            message = self.logout_grinplusplus_wallet()
+            if message is not None:
+                self.error_exit(message)
+            self.print_success()
 
 
 
@@ -708,7 +1538,7 @@ class Pool_Payout:
                     "n": "No",
                 }
             choice = self.prompt_menu("Found a signed slate file.  Process it?", options, "y")
-            print(" ")
+            print(" ", file=self.out)
             if choice == "Yes":
                 # Return the signed slate to the pool
                 self.print_progress("Returning the signed payment slate to the pool");
@@ -738,7 +1568,7 @@ class Pool_Payout:
                     "n": "No",
                 }
             choice = self.prompt_menu("Found a unsigned slate file.  Process it?", options, "y")
-            print(" ")
+            print(" ", file=self.out)
             if choice == "No":
                 self.unsigned_slate = None
                 self.clean_slate_files()
@@ -766,7 +1596,7 @@ class Pool_Payout:
             if not os.path.isfile(self.unsigned_slatefile):
                 self.error_exit(message)
             self.print_success()
-            print(" ")
+            print(" ", file=self.out)
             self.print_progress("Payment slate file written to")
             self.print_success("{}".format(self.unsigned_slatefile))
 
@@ -784,10 +1614,10 @@ class Pool_Payout:
 
         # Get the signed slate
         while self.signed_slate is None:
-            print(" ")
+            print(" ", file=self.out)
 #            self.print_indent("Paste the signed slate response JSON now, or enter the filename containing the response JSON:")
             self.print_indent("Enter the filename with signed slate response:", 1, False)
-            print(" ")
+            print(" ", file=self.out)
             choice = input("")
             if os.path.exists(choice):
                 try:
@@ -854,9 +1684,7 @@ class Pool_Payout:
 
 
 
-    def run(self):
-        ##
-        # Get configuration - either from commandline or by prompting the user
+    def make_parser(self):
         parser = argparse.ArgumentParser()
         parser.add_argument("--payout_method", help="Which payout method to use: {}".format(self.payout_methods))
         parser.add_argument("--pool_user", help="Username on {}".format(self.poolname))
@@ -864,9 +1692,59 @@ class Pool_Payout:
         parser.add_argument("--wallet_user", help="Your grin++ wallet username")
         parser.add_argument("--wallet_pass", help="Your grin wallet password")
         parser.add_argument("--wallet_url", help="Your grin wallet http/https url")
-        self.args = parser.parse_args()
+        parser.add_argument("--wallet_api_url", help="Your grin wallet owner API url (default: http://127.0.0.1:{}/v2/owner)".format(self.wallet_api_ports[0]))
+        parser.add_argument("--wallet_foreign_url", help="Your grin wallet foreign API listener url (default: http://127.0.0.1:{}/v2/foreign)".format(self.wallet_api_ports[1]))
+        parser.add_argument("--wallet_dir", help="Directory to run the grin-wallet or wallet713 command in, so the wallet config there (such as grin-wallet.toml) is used (default: current directory)")
+        parser.add_argument("--wallet_api_secret", help="Your grin wallet owner API secret file (default: {})".format(self.wallet_api_secret))
+        parser.add_argument("--no_slate_files", help="Keep the payment slate in memory instead of writing slate files to the current directory", action="store_true")
+        parser.add_argument("--record", help="Record all pool API traffic to this file")
+        parser.add_argument("--replay", help="Replay pool API traffic from a file made with --record, instead of using the network")
+        parser.add_argument("--payout_profile", help="Use the options saved in this payout profile (commandline options override them)")
+        parser.add_argument("--save_profile", help="After a successful payout, save its options to this payout profile.  Passwords are only saved as env:NAME or file:path references")
+        parser.add_argument("--profiles_file", help="Payout profiles file (default: ~/.{}_payout_profiles.json)".format(self.poolname.lower()),
+                            default="~/.{}_payout_profiles.json".format(self.poolname.lower()))
+        parser.add_argument("--trace", help="Write a timed span for every stage, http call and wallet command to this file")
+        parser.add_argument("--trace_format", help="Format of the --trace file: jsonl or chrome (default: jsonl)", choices=["jsonl", "chrome"], default="jsonl")
+        parser.add_argument("--profile", help="Print a summary of where the time went", action="store_true")
+        parser.add_argument("--journal_dir", help="Directory for the journal of a payment in progress, a rerun resumes from it (default: current directory)", default=".")
+        parser.add_argument("--deadline", help="Give up if the payout is not done in this many seconds, naming the stage that ran out of time.  Every pool, wallet and Grin++ call gets only the time left (default: no deadline)", type=float)
+        parser.add_argument("--discard_journal", help="Forget a payment in progress and start over", action="store_true")
+        parser.add_argument("--batch", help="Pay out every account in this csv file, with a header of: {}".format(",".join(self.batch_columns)))
+        parser.add_argument("--batch_workers", help="Number of accounts to pay out at once in batch mode (default: 8)", type=int, default=8)
+        parser.add_argument("--batch_results", help="Write the batch results to this json file (default: payout_results.json)", default="payout_results.json")
+        parser.add_argument("--daemon", help="Keep running, and request a payment whenever the balance reaches --threshold (with --batch: for every account in the file)", action="store_true")
+        parser.add_argument("--threshold", help="Daemon mode: balance that triggers a payment (default: the pool minimum payout)", type=float)
+        parser.add_argument("--poll_interval", help="Daemon mode: shortest time between balance checks, in seconds (default: 600)", type=int, default=600)
+        parser.add_argument("--max_poll_interval", help="Daemon mode: longest time between balance checks, in seconds (default: 3600)", type=int, default=3600)
+        parser.add_argument("--daemon_state", help="Daemon mode: state file (default: payout_daemon_state.json)", default="payout_daemon_state.json")
+        return parser
+
+    def run(self):
+        ##
+        # Get configuration - either from commandline or by prompting the user
+        self.args = self.make_parser().parse_args()
+        self.tracer.enabled = self.args.trace is not None or self.args.profile
     
         self.print_banner()
+
+        if self.args.payout_profile is not None:
+            self.load_profile()
+        # Passwords may be given as env:NAME or file:path references
+        for option in self.batch_secrets:
+            value = getattr(self.args, option)
+            if value is not None and (value.startswith("env:") or value.startswith("file:")):
+                self.secret_refs[option] = value
+                try:
+                    setattr(self.args, option, resolve_secret(value))
+                except (OSError, ValueError) as e:
+                    self.error_exit("Could not read {}: {}".format(option, str(e)))
+
+        if self.args.daemon and self.args.batch is not None:
+            self.run_daemon()
+            return
+        if self.args.batch is not None:
+            self.run_batch()
+            return
     
         ##
         # Process commandline Arguments
@@ -882,12 +1760,12 @@ class Pool_Payout:
             self.payout_method = self.args.payout_method
 
         if self.prompted:
-            print(" ")
+            print(" ", file=self.out)
     
         self.print_indent("** Requesting a payment from the pool using method: {}".format(self.payout_method))
 
         if self.prompted:
-            print(" ")
+            print(" ", file=self.out)
     
         if self.args.pool_user is None:
             self.username = input("   {} Username: ".format(self.poolname))
@@ -902,27 +1780,523 @@ class Pool_Payout:
             self.password = self.args.pool_pass
     
         if self.prompted:
-            print(" ")
+            print(" ", file=self.out)
     
+        if self.args.daemon:
+            self.run_daemon()
+            return
+
+        self.run_payout()
+
+        # Save the options of this payout, or the wallet found when the saved one changed
+        if self.args.save_profile is not None:
+            self.save_profile(self.args.save_profile)
+        elif self.profile is not None and len(self.found_wallets) > 0:
+            self.save_profile(self.args.payout_profile)
+
+        # Done
+        self.print_footer()
+
+    ##
+    # Payout profiles: named sets of options in the profiles file, so that a scripted payout
+    # needs no prompts and does not search for the wallet
+    def read_profiles(self):
+        filename = os.path.expanduser(self.args.profiles_file)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as profilesfile:
+            return json.load(profilesfile)
+
+    def load_profile(self):
+        name = self.args.payout_profile
+        try:
+            profile = self.read_profiles().get(name)
+        except (OSError, ValueError) as e:
+            self.error_exit("Could not read payout profiles file: {}".format(str(e)))
+        if profile is None:
+            self.error_exit("No payout profile named {} in {}".format(name, self.args.profiles_file))
+        if profile.get("pool", self.poolname) != self.poolname:
+            self.error_exit("Payout profile {} is for {}, not {}".format(name, profile["pool"], self.poolname))
+        for option in self.batch_columns:
+            if getattr(self.args, option) is None and profile.get(option) is not None:
+                setattr(self.args, option, profile[option])
+        if profile.get("walletflags") is not None:
+            self.walletflags = profile["walletflags"]
+        self.profile = profile
+
+    def save_profile(self, name):
+        try:
+            profiles = self.read_profiles()
+        except (OSError, ValueError) as e:
+            self.error("Could not read payout profiles file: {}".format(str(e)))
+            return
+        profile = dict(profiles.get(name, {}))
+        profile["pool"] = self.poolname
+        profile["payout_method"] = self.payout_method
+        profile["pool_user"] = self.username
+        for option in self.batch_columns:
+            if option in self.batch_secrets:
+                # Only references are saved, never a password
+                if option in self.secret_refs:
+                    profile[option] = self.secret_refs[option]
+            elif option not in profile or getattr(self.args, option) is not None:
+                profile[option] = getattr(self.args, option)
+        profile["walletflags"] = self.walletflags
+        wallets = dict(profile.get("wallets", {}))
+        wallets.update(self.found_wallets)
+        profile["wallets"] = wallets
+        profiles[name] = profile
+        filename = os.path.expanduser(self.args.profiles_file)
+        try:
+            tmpfile = filename + ".tmp"
+            fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as profilesfile:
+                json.dump(profiles, profilesfile, indent=2)
+            os.replace(tmpfile, filename)
+        except OSError as e:
+            self.error("Could not save payout profile: {}".format(str(e)))
+            return
+        self.print_indent("Payout profile {} saved to: {}".format(name, self.args.profiles_file))
+
+    # Request the payment, once the payout method and pool credentials are known
+    def run_payout(self):
+        self.start_deadline()
+
+        ##
+        # Record or replay the pool API traffic
+        try:
+            if self.args.record is not None and self.args.replay is not None:
+                self.error_exit("--record and --replay can not be used together")
+            elif self.args.record is not None:
+                self.pool_http = Pool_API_Tape(self.args.record, "record", self.pool_http)
+            elif self.args.replay is not None:
+                self.pool_http = Pool_API_Tape(self.args.replay, "replay", self.pool_http)
+        except (OSError, ValueError) as e:
+            self.error_exit("Could not open tape file: {}".format(str(e)))
+
+        ##
+        # Keep slates out of the current directory
+        if self.args.no_slate_files:
+            if self.payout_method == "Slate Files":
+                self.error_exit("--no_slate_files can not be used with the Slate Files payout method")
+            self.slate_files = False
+            if self.payout_method in ["Grin Wallet", "BitGrin Wallet", "Wallet713"]:
+                self.use_private_slate_dir()
+
+        ##
+        # Resume a payment that did not complete
+        if self.payout_method in ["Grin Wallet", "BitGrin Wallet", "Grin Wallet API", "Grin++ Wallet", "Wallet713"]:
+            self.open_journal()
 
         ##
         # Execute the requested payment method
-        if self.payout_method == "Grin Wallet" or self.payout_method == "BitGrin Wallet":
-            self.run_grin_wallet()
-        elif self.payout_method == "Grin++ Wallet":
-            self.run_grinplusplus_wallet()
-        elif self.payout_method == "Wallet713":
-            self.run_wallet713()
-        elif self.payout_method == "Slate Files":
-            self.run_slate()
-        elif self.payout_method == "http/https":
-            self.run_http()
-        else:
-            self.error_exit("Invalid payout method requested: {}".format(self.payout_method))
+        try:
+            if self.payout_method == "Grin Wallet" or self.payout_method == "BitGrin Wallet":
+                self.run_grin_wallet()
+            elif self.payout_method == "Grin Wallet API":
+                self.run_grin_wallet_api()
+            elif self.payout_method == "Grin++ Wallet":
+                self.run_grinplusplus_wallet()
+            elif self.payout_method == "Wallet713":
+                self.run_wallet713()
+            elif self.payout_method == "Slate Files":
+                self.run_slate()
+            elif self.payout_method == "http/https":
+                self.run_http()
+            else:
+                self.error_exit("Invalid payout method requested: {}".format(self.payout_method))
+        except (Tape_Miss, Deadline_Exceeded) as e:
+            self.error_exit(str(e))
+        except requests.exceptions.RequestException as e:
+            self.error_exit("Pool API request failed: {}".format(str(e)))
+        finally:
+            self.remove_private_slate_dir()
+            self.pool_http.close()
 
-        # Done
+    ##
+    # Pay out many accounts.  Each account gets its own Pool_Payout, so slates, sessions
+    # and output are never shared between accounts
+    def run_batch(self):
+        if self.args.record is not None or self.args.replay is not None:
+            self.error_exit("--record and --replay can not be used with --batch")
+        if self.args.batch_workers < 1:
+            self.error_exit("--batch_workers must be at least 1")
+        try:
+            accounts = self.read_batch_accounts(self.args.batch)
+        except (OSError, ValueError, csv.Error) as e:
+            self.error_exit("Could not read accounts file: {}".format(str(e)))
+        self.print_indent("** Requesting payments for {} accounts, {} at a time".format(len(accounts), self.args.batch_workers))
+        print(" ", file=self.out)
+
+        results = [None] * len(accounts)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.batch_workers) as executor:
+            futures = {executor.submit(self.run_batch_account, account): index for index, account in enumerate(accounts)}
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                results[futures[future]] = result
+                if result["status"] == "ok":
+                    status = "Ok"
+                else:
+                    status = "Failed: {}".format(result["error"])
+                self.print_indent("... {} ({}):  {}".format(result["pool_user"], result["payout_method"], status))
+
+        Grinplusplus_Client.close_all()
+        self.print_batch_summary(results)
+        try:
+            with open(self.args.batch_results, "w") as resultsfile:
+                json.dump(results, resultsfile, indent=2)
+            self.print_indent("Results written to: {}".format(self.args.batch_results))
+        except OSError as e:
+            self.error("Could not write batch results: {}".format(str(e)))
+        self.print_footer()
+        if any(result["status"] != "ok" for result in results):
+            sys.exit(1)
+
+    def read_batch_accounts(self, filename):
+        accounts = []
+        with open(filename, newline='') as accountsfile:
+            for row in csv.DictReader(accountsfile):
+                account = {}
+                for column in self.batch_columns:
+                    value = (row.get(column) or "").strip()
+                    account[column] = value if value != "" else None
+                if account["pool_user"] is None or account["pool_user"].startswith("#"):
+                    continue
+                accounts.append(account)
+        return accounts
+
+    # Commandline arguments for one account of a batch: the columns it has in the accounts file,
+    # with credential references resolved, and every other option as given for the whole batch
+    def batch_args(self, account, options):
+        args = argparse.Namespace(**vars(options))
+        for column in self.batch_columns:
+            value = account[column]
+            if value is None:
+                continue
+            if column in self.batch_secrets:
+                try:
+                    value = resolve_secret(value)
+                except (OSError, ValueError) as e:
+                    self.error_exit("Could not read {}: {}".format(column, str(e)))
+            setattr(args, column, value)
+        if args.payout_method is None:
+            self.error_exit("No payout_method given")
+        if args.payout_method == "Slate Files":
+            self.error_exit("The Slate Files payout method can not be used in batch mode")
+        for column in ["pool_pass"] + self.batch_required.get(args.payout_method, []):
+            if getattr(args, column) is None:
+                self.error_exit("No {} given for payout method {}".format(column, args.payout_method))
+        args.no_slate_files = True
+        return args
+
+    # The lock of the wallet command and directory an account's payout runs, or None if it runs
+    # none.  Accounts that use the same wallet take turns
+    def batch_wallet_lock(self, args):
+        if args.payout_method not in self.cli_wallet_methods:
+            return None
+        wallet_dir = args.wallet_dir
+        if wallet_dir is not None:
+            wallet_dir = os.path.abspath(os.path.expanduser(wallet_dir))
+        with self.wallet_locks_lock:
+            return self.wallet_locks.setdefault((args.payout_method, wallet_dir), threading.Lock())
+
+    # Pay out one batch account, returns its result
+    def run_batch_account(self, account):
+        payout = Pool_Payout(self.tracer)
+        payout.batch = True
+        payout.out = io.StringIO()
+        result = {
+                "pool_user": account["pool_user"],
+                "payout_method": account["payout_method"] or self.args.payout_method,
+                "status": "failed",
+                "error": None,
+            }
+        start = time.time()
+        with self.tracer.span("account " + str(account["pool_user"]), "account") as span:
+            lock = None
+            try:
+                # The account is checked before it waits for its wallet, so a bad one fails at once
+                payout.args = payout.batch_args(account, self.args)
+                payout.payout_method = payout.args.payout_method
+                payout.username = payout.args.pool_user
+                payout.password = payout.args.pool_pass
+                lock = self.batch_wallet_lock(payout.args)
+                if lock is not None:
+                    lock.acquire()
+                payout.run_payout()
+                result["status"] = "ok"
+            except Payout_Error as e:
+                result["error"] = str(e).strip()
+            except Exception as e:
+                result["error"] = "Unexpected error: {}".format(str(e)).strip()
+            finally:
+                if lock is not None:
+                    lock.release()
+            span["status"] = result["status"]
+        result["balance"] = payout.balance
+        result["seconds"] = round(time.time() - start, 3)
+        result["output"] = payout.out.getvalue()
+        return result
+
+    def print_batch_summary(self, results):
+        print(" ", file=self.out)
+        self.print_indent("{:<24} {:<16} {:>8} {:>14} {:>9}  {}".format("User", "Method", "Status", "Balance", "Seconds", "Error"))
+        for result in results:
+            self.print_indent("{:<24} {:<16} {:>8} {:>14.9f} {:>9.2f}  {}".format(
+                    result["pool_user"], str(result["payout_method"]), result["status"], result["balance"], result["seconds"], " ".join((result["error"] or "").split())))
+        failed = len([result for result in results if result["status"] != "ok"])
+        print(" ", file=self.out)
+        self.print_indent("{} paid, {} failed".format(len(results) - failed, failed))
+
+
+
+    ##
+    # Daemon mode: poll the balance of each account, and request a payment when it reaches
+    # the threshold.  Polling is adaptive (sooner as the balance nears the threshold), errors
+    # back off exponentially, and state is saved after every change so a restart never
+    # requests a payment that may already be in progress
+    def run_daemon(self):
+        if self.args.record is not None or self.args.replay is not None:
+            self.error_exit("--record and --replay can not be used with --daemon")
+        threshold = self.args.threshold
+        if threshold is None:
+            threshold = self.POOL_MINIMUM_PAYOUT
+        if threshold < self.POOL_MINIMUM_PAYOUT:
+            self.error_exit("--threshold can not be below the pool minimum payout of {}".format(self.POOL_MINIMUM_PAYOUT))
+        if self.args.poll_interval < 1 or self.args.max_poll_interval < self.args.poll_interval:
+            self.error_exit("--poll_interval must be at least 1, and no more than --max_poll_interval")
+
+        if self.args.batch is not None:
+            try:
+                accounts = self.read_batch_accounts(self.args.batch)
+            except (OSError, ValueError, csv.Error) as e:
+                self.error_exit("Could not read accounts file: {}".format(str(e)))
+        else:
+            accounts = [{column: getattr(self.args, column, None) for column in self.batch_columns}]
+            accounts[0].update({"pool_user": self.username, "pool_pass": self.password, "payout_method": self.payout_method})
+
+        # Check every account before starting, so a daemon never stops later to prompt
+        pollers = {}
+        for account in accounts:
+            poller = Pool_Payout(self.tracer)
+            poller.batch = True
+            poller.out = io.StringIO()
+            try:
+                poller.args = poller.batch_args(account, self.args)
+            except Payout_Error as e:
+                self.error_exit("Account {}: {}".format(account["pool_user"], str(e)))
+            poller.username = poller.args.pool_user
+            poller.password = poller.args.pool_pass
+            pollers[poller.username] = poller
+
+        state = self.load_daemon_state()
+        for user in pollers:
+            state["accounts"].setdefault(user, {
+                    "balance": None,
+                    "polled": None,
+                    "rate": None,
+                    "errors": 0,
+                    "next_poll": 0,
+                    "pending": None,
+                    "last_error": None,
+                    "failed": None,
+                })
+
+        # --discard_journal applies once, at startup: it forgets the payments in progress
+        # and the accounts that were given up on
+        for user, poller in pollers.items():
+            account_state = state["accounts"][user]
+            if self.args.discard_journal:
+                try:
+                    poller.open_journal()
+                except Payout_Error as e:
+                    self.error_exit("Account {}: {}".format(user, str(e)))
+                poller.args.discard_journal = False
+                account_state["pending"] = None
+                account_state["failed"] = None
+            elif account_state.get("failed") is not None:
+                self.daemon_log(user, "Skipped, {}".format(account_state["failed"]))
+        self.save_daemon_state(state)
+
+        self.print_indent("** Watching {} accounts, payout threshold: {}".format(len(pollers), threshold))
+        print(" ", file=self.out)
+
+        def stop(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            while True:
+                now = time.time()
+                for user, poller in pollers.items():
+                    account_state = state["accounts"][user]
+                    if account_state["next_poll"] <= now:
+                        self.daemon_poll(poller, account_state, threshold)
+                        self.save_daemon_state(state)
+                next_poll = min(state["accounts"][user]["next_poll"] for user in pollers)
+                time.sleep(max(next_poll - time.time(), 0))
+        except KeyboardInterrupt:
+            self.save_daemon_state(state)
+            self.print_indent("Stopped, state saved to: {}".format(self.args.daemon_state))
+        finally:
+            for poller in pollers.values():
+                poller.pool_http.close()
+            Grinplusplus_Client.close_all()
         self.print_footer()
 
+    def daemon_log(self, user, message):
+        self.print_indent("{} {}: {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user, message))
+
+    # The journal step of an account's payment in progress, or None
+    def daemon_journal_step(self, poller):
+        try:
+            poller.open_journal()
+        except Payout_Error:
+            # The payout reports an unreadable journal itself
+            return None
+        return poller.journal.step()
+
+    # Check one account's balance, and request a payment when it is due
+    def daemon_poll(self, poller, account_state, threshold):
+        now = time.time()
+        user = poller.username
+        if account_state.get("failed") is not None:
+            account_state["next_poll"] = now + self.args.max_poll_interval
+            return
+        try:
+            message = None
+            if poller.user_id is None:
+                message = poller.get_user_id()
+            if message is None:
+                message = poller.get_balance()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            message = "Pool API request failed: {}".format(str(e))
+        if message is not None:
+            account_state["errors"] += 1
+            account_state["last_error"] = message
+            account_state["next_poll"] = now + self.daemon_interval(account_state, threshold)
+            self.daemon_log(user, "{}, retrying in {}s".format(message, int(account_state["next_poll"] - now)))
+            return
+
+        balance = poller.balance
+        if account_state["balance"] is not None and account_state["polled"] is not None and balance >= account_state["balance"] and now > account_state["polled"]:
+            account_state["rate"] = (balance - account_state["balance"]) / (now - account_state["polled"])
+        else:
+            account_state["rate"] = None
+        account_state["balance"] = balance
+        account_state["polled"] = now
+
+        # A payment in the journal was requested but not completed.  It is resumed from the
+        # journal, with the error backoff, until the pending timeout.  Then the account is given
+        # up on until a restart with --discard_journal
+        pending = account_state["pending"]
+        step = self.daemon_journal_step(poller)
+        if step is not None:
+            started = pending["time"] if pending is not None else poller.journal.entry["time"]
+            if now - started > self.daemon_pending_timeout:
+                account_state["pending"] = None
+                account_state["failed"] = "the payment requested at {} did not complete (journal step: {}), restart with --discard_journal to start over".format(
+                        datetime.datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M:%S"), step)
+                account_state["next_poll"] = now + self.args.max_poll_interval
+                self.daemon_log(user, "Giving up, {}".format(account_state["failed"]))
+                return
+            self.daemon_log(user, "Resuming the payment requested at {}, from step: {}".format(
+                    datetime.datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M:%S"), step))
+            self.daemon_payout(poller, account_state)
+            account_state["next_poll"] = time.time() + self.daemon_interval(account_state, threshold)
+            return
+        account_state["errors"] = 0
+        account_state["last_error"] = None
+
+        # A payment requested earlier (perhaps before a restart), or completed, with nothing left
+        # in the journal is done once its amount has left the balance.  Until then, or until it
+        # times out, it is not requested again
+        if pending is not None:
+            if balance < pending["balance"]:
+                account_state["pending"] = None
+                self.daemon_log(user, "Payment of {} has left the balance".format(pending["balance"]))
+            elif now - pending["time"] > self.daemon_pending_timeout:
+                account_state["pending"] = None
+                self.daemon_log(user, "Payment requested at {} was not seen, it will be requested again".format(
+                        datetime.datetime.fromtimestamp(pending["time"]).strftime("%Y-%m-%d %H:%M:%S")))
+            else:
+                account_state["next_poll"] = now + self.args.poll_interval
+                self.daemon_log(user, "Balance {}, waiting for the payment requested earlier".format(balance))
+                return
+
+        if balance >= threshold and account_state["pending"] is None:
+            self.daemon_payout(poller, account_state)
+            account_state["next_poll"] = time.time() + self.daemon_interval(account_state, threshold)
+            return
+
+        account_state["next_poll"] = now + self.daemon_interval(account_state, threshold)
+        self.daemon_log(user, "Balance {}, next check in {}s".format(balance, int(account_state["next_poll"] - now)))
+
+    # Seconds until an account is polled again
+    def daemon_interval(self, account_state, threshold):
+        shortest = self.args.poll_interval
+        longest = self.args.max_poll_interval
+        if account_state["errors"] > 0:
+            backoff = min(shortest * 2**(account_state["errors"]-1), longest)
+            return random.uniform(backoff/2, backoff)
+        rate = account_state["rate"]
+        if rate is None or rate <= 0 or account_state["balance"] is None:
+            return shortest
+        # Expected time for the balance to reach the threshold
+        return min(max((threshold - account_state["balance"]) / rate, shortest), longest)
+
+    def daemon_payout(self, poller, account_state):
+        user = poller.username
+        # Save the pending marker before anything is requested from the pool.  A resumed
+        # payment keeps the marker of its first request
+        if account_state["pending"] is None:
+            account_state["pending"] = {"time": time.time(), "balance": account_state["balance"]}
+            self.save_daemon_state(self.daemon_state)
+            self.daemon_log(user, "Balance {}, requesting a payment with {}".format(account_state["balance"], poller.args.payout_method))
+        payout = Pool_Payout(self.tracer)
+        payout.batch = True
+        payout.out = io.StringIO()
+        payout.args = poller.args
+        payout.payout_method = poller.args.payout_method
+        payout.username = poller.username
+        payout.password = poller.password
+        try:
+            payout.run_payout()
+        except Exception as e:
+            account_state["errors"] += 1
+            account_state["last_error"] = str(e)
+            in_journal = payout.journal is not None and payout.journal.step() is not None
+            if payout.unsigned_slate is None and not in_journal:
+                # No slate was requested, so nothing is in progress at the pool
+                account_state["pending"] = None
+            self.daemon_log(user, "Payment failed: {}".format(str(e)))
+            return
+        # The pool accepted the signed slate (or the http payment request).  The account stays
+        # pending until the pool balance shows the payment
+        account_state["errors"] = 0
+        account_state["last_error"] = None
+        account_state["balance"] = None
+        account_state["rate"] = None
+        self.daemon_log(user, "Payment of {} complete".format(payout.balance))
+
+    def load_daemon_state(self):
+        self.daemon_state = {"accounts": {}}
+        if os.path.exists(self.args.daemon_state):
+            try:
+                with open(self.args.daemon_state) as statefile:
+                    self.daemon_state = json.load(statefile)
+            except (OSError, ValueError) as e:
+                self.error_exit("Could not read daemon state file: {}".format(str(e)))
+        return self.daemon_state
+
+    # Write the state to a temporary file and rename it into place, so a crash never
+    # leaves a partly written state file
+    def save_daemon_state(self, state):
+        tmpfile = self.args.daemon_state + ".tmp"
+        with open(tmpfile, "w") as statefile:
+            json.dump(state, statefile, indent=2)
+            statefile.flush()
+            os.fsync(statefile.fileno())
+        os.replace(tmpfile, self.args.daemon_state)
 
 
 if __name__ == "__main__":
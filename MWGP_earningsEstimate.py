@@ -18,40 +18,96 @@
 ###
 # Estmate MWGrinPool earnings from historic data
 # Input: --days, --c29gps, --c31gps
+#    or: --days, --c29-grid, --c31-grid and/or --rigs (sweep many GPS scenarios in one run)
 
 # Algorithm:
-#   Get a list of the blocks found by MWGrinPool within the requested block range
-#   For each pool-found-block:
+#   Walk back through the blocks found by MWGrinPool, one page at a time, until the start of the range
+#   For each page of pool-found-blocks:
+#       Fetch the grin block and pool stats for each pool-found-block (optionally in parallel)
+#           Blocks already in the local cache are not fetched again
+#           With --bulk, heights are loaded in pages from the range endpoints and joined in memory
 #       Calculate the theoritical rewards for a user with provided GPS
+#           (all blocks in the page at once, as numpy arrays, when numpy is installed)
+#   Calculate the running average daily reward
 #   Generate a graph
+#
+# With --trace and/or --profile, time every API request and the fetch, compute and render phases
+#
+# With --watch, keep the window of blocks and their rewards in memory and every interval only
+# fetch the pool blocks found since the last update, expiring blocks that fall out of the window
+#
+# Library use:
+#   import MWGP_earningsEstimate
+#   result = MWGP_earningsEstimate.estimate(days=7, c29gps=2, c31gps=0.5)
+#   print(result.total, result.daily)
 
 import os
+import re
 import sys
+import csv
+import gzip
+import json
+import time
+import hashlib
+import sqlite3
 import argparse
+import threading
+import importlib.util
+from contextlib import contextmanager
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+# requests and plotly are imported when first needed, so text mode and library use start fast
 try:
-    import requests
-except Exception as e:
-    print("Error:  This script requires the 'requests' module, please run `pip3 install requests`")
-Graph = True
-try:
-    import plotly
-    import plotly.graph_objs as go
+    import numpy as np
 except Exception as e:
-    Graph = False
+    np = None
 
 mwURL = "https://api.mwgrinpool.com"
 NanoGrin = 1.0/1000000000.0
 SecondsInDay = float(60*60*24)
 PPLNGSeconds = float(60*60*4)
 PoolFee = 0.02
+BulkPageSize = 1000  # Max number of heights per range request
+PoolBlocksPageSize = 1440  # Number of pool blocks per page of history
+DefaultRequestBudget = 10000  # Max number of API requests per run (per update in watch mode)
+WatchResyncEvery = 1440  # Re-sum the watch window after this many updates to shed rounding drift
+WatchFirstPageSize = 16  # Pool blocks in the first page of a watch update, doubled until a seen height
+PrimaryScale = 2**(1+31-24)*31
+CacheMinAge = float(60*60)  # Only cache blocks that are buried at least this long
+CacheCommitEvery = 100
 
-def print_header():
+EstimateResult = namedtuple("EstimateResult", [
+    "days", "c29gps", "c31gps", "start", "end",
+    "total", "daily",   # Total and average daily reward in Grin
+    "blocks", "requests",  # Number of pool blocks and API requests used
+    "x", "y",  # Average daily reward over time, for graphing (None unless estimate(series=True))
+])
+
+WatchUpdate = namedtuple("WatchUpdate", [
+    "time", "start",
+    "total", "daily",
+    "blocks",  # Number of pool blocks in the window
+    "new_blocks", "expired_blocks", "requests",
+    "error",  # Why the update failed, or None.  total and daily are None then, and the window is kept
+])
+
+SweepResult = namedtuple("SweepResult", [
+    "days", "start", "end",
+    "scenarios",  # [(name, c29gps, c31gps)]
+    "totals",  # Total reward in Grin for each scenario
+    "blocks", "requests",
+])
+
+def graph_available():
+    return importlib.util.find_spec("plotly") is not None
+
+def print_header(graph=True):
     print(" ")
     print("############# MWGrinPool Average Daily Earnings #############")
     print("## ")
-    if Graph == False:
+    if graph and not graph_available():
         print("   WARNING: ")
         print("     This script requires the 'plotly' module to produce a graph")
         print("     Please run: `pip3 install plotly`")
@@ -65,126 +121,457 @@ def print_footer(rewardTotal, c29gps, c31gps, numDays, startTS, endTS):
     print("   Mining C29 at {}gps, C31 at {}gps".format(c29gps, c31gps))
     print(" ")
     print("   Total Rewards: {} Grin".format(rewardTotal))
-    print("   Avg Daily Reward = {} Grin".format(rewardTotal/NumDays))
+    print("   Avg Daily Reward = {} Grin".format(rewardTotal/numDays))
     print(" ")
 
 def epoch_to_dt(epoch):
     return datetime.fromtimestamp(epoch)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--days", help="Number of days to average over")
-parser.add_argument("--c29gps", help="Miners C29 Graphs/second")
-parser.add_argument("--c31gps", help="Miners C31 Graphs/second")
-parser.add_argument("--debug", help="Print lots of debug info", action='store_true')
-parser.add_argument("--no-graph", help="Dont generate graph", action='store_false', dest='Graph')
-args = parser.parse_args()
+class RequestBudgetExceeded(Exception):
+    pass
 
+class TapeMiss(Exception):
+    pass
 
-print_header()
+class TapeResponse:
+    # The parts of a requests.Response that a recorded response can provide
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode("utf-8")
 
-if args.days is None:
-    NumDays = float(input("   Number of days to average over: "))
-else:
-    NumDays = float(args.days)
+    def json(self):
+        return json.loads(self.text)
 
-if NumDays > 62:
-    print(" ")
-    print("   -- Error: Please limit your query to 60 days to prevent excess load on our pool API")
-    print(" ")
-    sys.exit(1)
+class APITape:
+    # Record pool API traffic to, or replay it from, a gzipped json-lines file.
+    # Each line is one request/response; on replay they are indexed by method, url and a
+    # digest of the request body, and repeated requests are answered in recorded order.
+    # Credentials (auth, headers) are never written to the tape
+    def __init__(self, filename, mode):
+        if mode not in ("record", "replay"):
+            raise ValueError("Unknown tape mode: {}".format(mode))
+        self.filename = filename
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.index = {}
+        if mode == "record":
+            self.tapefile = gzip.open(filename, "wt", encoding="utf-8")
+            return
+        self.tapefile = None
+        with gzip.open(filename, "rt", encoding="utf-8") as tapefile:
+            for line in tapefile:
+                entry = json.loads(line)
+                key = (entry["method"], entry["url"], entry["body"])
+                self.index.setdefault(key, []).append(entry)
+
+    def key(self, method, url, data):
+        if data is None:
+            body = None
+        else:
+            if not isinstance(data, bytes):
+                data = str(data).encode("utf-8")
+            body = hashlib.sha1(data).hexdigest()
+        return (method, url, body)
 
-if args.c29gps is None:
-    C29Gps = float(input("   Miners C29 Graphs/second: "))
-else:
-    C29Gps = float(args.c29gps)
+    def request(self, method, url, data=None, **kwargs):
+        key = self.key(method, url, data)
+        if self.mode == "replay":
+            with self.lock:
+                entries = self.index.get(key)
+                if not entries:
+                    raise TapeMiss("No recorded response for {} {}".format(method, url))
+                # Keep serving the last response once the recorded ones are used up
+                entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            return TapeResponse(entry["status"], entry["text"])
+        import requests
+        r = requests.request(method, url, data=data, **kwargs)
+        entry = {"method": key[0], "url": key[1], "body": key[2], "status": r.status_code, "text": r.text}
+        with self.lock:
+            self.tapefile.write(json.dumps(entry) + "\n")
+        return r
 
-if args.c31gps is None:
-    C31Gps = float(input("   Miners C31 Graphs/second: "))
-else:
-    C31Gps = float(args.c31gps)
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
 
-if args.debug is None:
-    debug = False
-else:
-    debug = bool(args.debug)
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
 
-if args.Graph is None:
-    Graph = True
-else:
-    Graph = bool(args.Graph)
+    def close(self):
+        if self.tapefile is not None:
+            self.tapefile.close()
+            self.tapefile = None
 
+class Tracer:
+    # Timed spans for the API requests and the phases of a run.  A disabled tracer records
+    # nothing.  Spans are written as json-lines or in the Chrome trace event format, and
+    # summarised by name with print_profile()
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = []
+        self.lock = threading.Lock()
 
+    @contextmanager
+    def span(self, name, category, **args):
+        # Yields the span's args, so the caller can add results such as status and bytes
+        if not self.enabled:
+            yield args
+            return
+        start = time.time()
+        startCounter = time.perf_counter()
+        try:
+            yield args
+        finally:
+            span = {"name": name, "cat": category, "start": start, "dur": time.perf_counter() - startCounter,
+                    "tid": threading.get_ident(), "args": args}
+            with self.lock:
+                self.spans.append(span)
 
-EndTS = datetime.now()
-startTS = EndTS - timedelta(days=NumDays)
+    def write(self, filename, format="jsonl"):
+        with open(filename, "w") as tracefile:
+            if format == "chrome":
+                pid = os.getpid()
+                events = [{"name": span["name"], "cat": span["cat"], "ph": "X", "ts": span["start"]*1000000,
+                           "dur": span["dur"]*1000000, "pid": pid, "tid": span["tid"], "args": span["args"]}
+                          for span in self.spans]
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, tracefile)
+            else:
+                for span in self.spans:
+                    tracefile.write(json.dumps(span) + "\n")
 
+    def print_profile(self):
+        # Count, total, mean and max time, and bytes received, for each span name
+        rows = {}
+        for span in self.spans:
+            row = rows.setdefault((span["cat"], span["name"]), [0, 0.0, 0.0, 0])
+            row[0] += 1
+            row[1] += span["dur"]
+            row[2] = max(row[2], span["dur"])
+            row[3] += span["args"].get("bytes", 0)
+        print(" ")
+        print("   {:<8} {:<48} {:>7} {:>11} {:>10} {:>10} {:>12}".format("Type", "Span", "Count", "Total (ms)", "Mean (ms)", "Max (ms)", "Bytes"))
+        for (category, name), (count, total, longest, size) in sorted(rows.items(), key=lambda item: -item[1][1]):
+            print("   {:<8} {:<48} {:>7} {:>11.1f} {:>10.2f} {:>10.2f} {:>12}".format(
+                category, name[:48], count, total*1000, total*1000/count, longest*1000, size))
+        print(" ")
 
-# Get a list of the pool-found-blocks within the range
-poolblocksURL = mwURL + "/pool/blocks/0,1440/timestamp,height"
-poolblocksJSON = requests.get(url = poolblocksURL).json()
-poolblocks = [block['height'] for block in poolblocksJSON if(block['timestamp'] >= startTS.timestamp() and block['timestamp'] <= EndTS.timestamp())]
-poolblocks.sort()
-debug and print("Pool Blocks found in range: {}".format(poolblocks))
+class PoolAPI:
+    # Pool API client that counts requests against an optional budget (None for no limit).
+    # Requests go through transport (an APITape) when one is given, and are timed by tracer
+    def __init__(self, url=mwURL, budget=None, transport=None, tracer=None):
+        self.url = url
+        self.budget = budget
+        self.transport = transport
+        self.tracer = Tracer(False) if tracer is None else tracer
+        self.count = 0
+        self.lock = threading.Lock()
 
-print(" ")
-print("   Getting Mining Data: ")
-rewardTotal = 0
-x = [startTS]
-y = [0]
-debug and print("Start Time: {} - {}".format(startTS, startTS.timestamp()))
-debug and print("End Time:   {} - {}".format(EndTS, EndTS.timestamp()))
-debug or sys.stdout.write("   ")
-sys.stdout.flush()
-for blockHeight in poolblocks:
-    # For each pool block, get some information:
+    # GET a pool API path and return the decoded json
+    def get(self, path):
+        with self.lock:
+            if self.budget is not None and self.count >= self.budget:
+                raise RequestBudgetExceeded("Request budget of {} API calls exhausted".format(self.budget))
+            self.count += 1
+        # Heights in the path are left out of the span name, so the profile groups by endpoint
+        with self.tracer.span("GET " + re.sub(r"\d+", "N", path), "http", path=path) as span:
+            if self.transport is not None:
+                r = self.transport.get(url = self.url + path)
+            else:
+                import requests
+                r = requests.get(url = self.url + path)
+            span["status"] = r.status_code
+            span["bytes"] = len(r.content)
+        return r.json()
+
+def iter_pool_block_pages(api, startEpoch, endEpoch, pageSize=PoolBlocksPageSize, sinceHeight=0, firstPageSize=None):
+    # Walk back through the pool-found-blocks, newest first, one page of pageSize blocks at a time.
+    # Yield the sorted heights of the blocks within [startEpoch, endEpoch] and above sinceHeight
+    # for each page, and stop once a page reaches back past startEpoch or sinceHeight.
+    # With firstPageSize the first page is that small, and each next one twice as big up to pageSize
+    height = 0  # Latest
+    size = pageSize if firstPageSize is None else min(firstPageSize, pageSize)
+    while True:
+        poolblocksURL = "/pool/blocks/{},{}/timestamp,height".format(height, size)
+        poolblocksJSON = api.get(poolblocksURL)
+        if len(poolblocksJSON) == 0:
+            return
+        page = [block['height'] for block in poolblocksJSON if(block['timestamp'] >= startEpoch and block['timestamp'] <= endEpoch and block['height'] > sinceHeight)]
+        page.sort()
+        if len(page) > 0:
+            yield page
+        oldest = min(poolblocksJSON, key=lambda block: block['height'])
+        if oldest['timestamp'] < startEpoch or oldest['height'] <= max(sinceHeight, 1):
+            return
+        height = oldest['height'] - 1
+        size = min(size*2, pageSize)
+
+def get_block_data(api, blockHeight):
+    # For a pool block, get some information:
     #   Secondary Scale Value
     #   Any TX fees included in the block reward
-    grinBlockURL = mwURL + "/grin/block/{}/timestamp,height,secondary_scaling,fee".format(blockHeight)
-    grinblockJSON = requests.get(url = grinBlockURL).json()
+    grinBlockURL = "/grin/block/{}/timestamp,height,secondary_scaling,fee".format(blockHeight)
+    grinblockJSON = api.get(grinBlockURL)
     #   Pool GPS at that block height
-    poolGpsURL = mwURL + "/pool/stat/{}/gps".format(blockHeight)
-    poolGpsJSON = requests.get(url = poolGpsURL).json()
-    #   Calculate theoretical miners reward
-    secondaryScale = max(29, grinblockJSON['secondary_scaling'])*2
-    primaryScale = (2**(1+31-24)*31)
-    minerValue = C29Gps*secondaryScale + C31Gps*primaryScale
-    poolValue = 0
+    poolGpsURL = "/pool/stat/{}/gps".format(blockHeight)
+    poolGpsJSON = api.get(poolGpsURL)
+    return grinblockJSON, poolGpsJSON
+
+def get_block_data_range(api, height, count):
+    # Get the grin blocks and pool stats for the `count` heights ending at `height`,
+    # as {height: grinblockJSON} and {height: poolGpsJSON}
+    grinBlocksURL = "/grin/blocks/{},{}/timestamp,height,secondary_scaling,fee".format(height, count)
+    grinblocksJSON = api.get(grinBlocksURL)
+    poolStatsURL = "/pool/stats/{},{}/height,gps".format(height, count)
+    poolstatsJSON = api.get(poolStatsURL)
+    grinblocks = {block['height']: block for block in grinblocksJSON}
+    poolstats = {stat['height']: stat for stat in poolstatsJSON}
+    return grinblocks, poolstats
+
+def get_block_data_page(api, page):
+    # Get the block data for a page of sorted heights with one range request per endpoint.
+    # Falls back to single block requests for any height missing from the range response
+    grinblocks, poolstats = get_block_data_range(api, page[-1], page[-1] - page[0] + 1)
+    pageData = []
+    for blockHeight in page:
+        if blockHeight in grinblocks and blockHeight in poolstats:
+            pageData.append((grinblocks[blockHeight], poolstats[blockHeight]))
+        else:
+            pageData.append(get_block_data(api, blockHeight))
+    return pageData
+
+def bulk_pages(heights, pageSize=BulkPageSize):
+    # Split sorted heights into pages that each span at most pageSize heights
+    pages = []
+    for blockHeight in heights:
+        if len(pages) > 0 and blockHeight - pages[-1][0] < pageSize:
+            pages[-1].append(blockHeight)
+        else:
+            pages.append([blockHeight])
+    return pages
+
+def iter_block_data(api, heights, concurrency=1, bulk=False):
+    # Yield (grinblockJSON, poolGpsJSON) for each height, in the order given.
+    # With concurrency > 1 the requests are spread over a bounded pool of worker threads.
+    # With bulk the (sorted) heights are fetched in pages using the range endpoints
+    if bulk:
+        fetch, items = (lambda page: get_block_data_page(api, page)), bulk_pages(heights)
+    else:
+        fetch, items = (lambda blockHeight: get_block_data(api, blockHeight)), heights
+    if concurrency <= 1:
+        results = map(fetch, items)
+    else:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        results = executor.map(fetch, items)
+    try:
+        for result in results:
+            if bulk:
+                for blockData in result:
+                    yield blockData
+            else:
+                yield result
+    finally:
+        if concurrency > 1:
+            executor.shutdown(wait=True)
+
+class BlockCache:
+    # Local sqlite cache of grin block headers and pool stats, keyed by pool + height
+    def __init__(self, filename, pool):
+        self.pool = pool
+        self.pending = 0
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS blocks ("
+                        "pool TEXT NOT NULL, "
+                        "height INTEGER NOT NULL, "
+                        "block TEXT NOT NULL, "
+                        "gps TEXT NOT NULL, "
+                        "PRIMARY KEY (pool, height))")
+        self.db.commit()
+
+    # Return {height: (grinblockJSON, poolGpsJSON)} for the cached heights
+    def get(self, heights):
+        found = {}
+        heights = list(heights)
+        for index in range(0, len(heights), 500):
+            chunk = heights[index:index+500]
+            query = "SELECT height, block, gps FROM blocks WHERE pool = ? AND height IN ({})".format(",".join("?"*len(chunk)))
+            for height, block, gps in self.db.execute(query, [self.pool] + chunk):
+                found[height] = (json.loads(block), json.loads(gps))
+        return found
+
+    def put(self, height, blockData):
+        grinblockJSON, poolGpsJSON = blockData
+        self.db.execute("INSERT OR REPLACE INTO blocks (pool, height, block, gps) VALUES (?, ?, ?, ?)",
+                        (self.pool, height, json.dumps(grinblockJSON), json.dumps(poolGpsJSON)))
+        self.pending += 1
+        if self.pending >= CacheCommitEvery:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def iter_cached_block_data(api, heights, cache, concurrency=1, bulk=False, debug=False):
+    # Like iter_block_data, but serve what we can from the cache and only fetch the missing heights.
+    # Newly fetched blocks are added to the cache once they are old enough to be final
+    cached = cache.get(heights)
+    missing = [blockHeight for blockHeight in heights if blockHeight not in cached]
+    debug and print("Cache hits: {}, fetching: {}".format(len(cached), len(missing)))
+    fetched = iter_block_data(api, missing, concurrency, bulk)
+    buried = time.time() - CacheMinAge
+    for blockHeight in heights:
+        if blockHeight in cached:
+            yield cached[blockHeight]
+            continue
+        blockData = next(fetched)
+        if blockData[0]['timestamp'] <= buried:
+            cache.put(blockHeight, blockData)
+        yield blockData
+    cache.commit()
+
+def new_block_columns():
+    # Columnar block data, one list per field, used as input to the reward engine
+    return {
+        "height": [],
+        "timestamp": [],
+        "secondary_scaling": [],
+        "fee": [],
+        "pool_secondary_gps": [],
+        "pool_primary_gps": [],
+    }
+
+def add_block_columns(columns, blockHeight, grinblockJSON, poolGpsJSON):
+    # Append one block to the columns, splitting the pool gps into secondary (C29) and primary PoW
+    secondaryGps = 0
+    primaryGps = 0
     for gps in poolGpsJSON['gps']:
         if gps['edge_bits'] == 29:
-            poolValue += gps['gps']*secondaryScale
+            secondaryGps += gps['gps']
         else:
-            poolValue += gps['gps']*primaryScale
-    debug and print("Miner value: {}, pool value: {}".format(minerValue, poolValue))
-    fullMinersReward = (minerValue/poolValue)*(60+grinblockJSON['fee']*NanoGrin)*(1.0-PoolFee)
-    tsNow = datetime.fromtimestamp(grinblockJSON['timestamp'])
-    timedelta = tsNow - startTS
+            primaryGps += gps['gps']
+    columns["height"].append(blockHeight)
+    columns["timestamp"].append(grinblockJSON['timestamp'])
+    columns["secondary_scaling"].append(grinblockJSON['secondary_scaling'])
+    columns["fee"].append(grinblockJSON['fee'])
+    columns["pool_secondary_gps"].append(secondaryGps)
+    columns["pool_primary_gps"].append(primaryGps)
+
+def compute_reward_coefficients(columns, startEpoch):
+    # The miners reward for a block is linear in its gps:  reward = c29gps*c29Coeff + c31gps*c31Coeff
+    # Return the per-block (c29Coeff, c31Coeff)
+    if np is None:
+        return compute_reward_coefficients_scalar(columns, startEpoch)
+    timestamps = np.asarray(columns["timestamp"], dtype=np.float64)
+    secondaryScale = np.maximum(29, np.asarray(columns["secondary_scaling"], dtype=np.float64))*2
+    poolValue = np.asarray(columns["pool_secondary_gps"], dtype=np.float64)*secondaryScale + \
+                np.asarray(columns["pool_primary_gps"], dtype=np.float64)*PrimaryScale
+    fees = np.asarray(columns["fee"], dtype=np.float64)
+    blockValue = (60+fees*NanoGrin)*(1.0-PoolFee)/poolValue
     # Check if we get the full reward or not (were we mining for the entire PPLNG)
-    if(timedelta.total_seconds() < PPLNGSeconds):
-        minersReward = fullMinersReward * (timedelta.total_seconds()/PPLNGSeconds)
-    else:
-        minersReward = fullMinersReward
-    debug and print("   + Miners reward for {} block {}: {}".format(datetime.fromtimestamp(grinblockJSON['timestamp']).strftime('%c'), blockHeight, minersReward))
-    rewardTotal += minersReward
-    # Graph
-    x.append(tsNow)
-    timedelta = tsNow - startTS
-    debug and print("timedelta = {}".format(timedelta))
-    daysSinceStartTS = float(timedelta.total_seconds())/float(SecondsInDay)
-    debug and print("daysSinceStartTS = {}".format(daysSinceStartTS))
-    y.append(rewardTotal/daysSinceStartTS)
-    debug and print(" ")
-    # Status
-    debug or sys.stdout.write(".")
-    sys.stdout.flush()
+    secondsSinceStart = timestamps - startEpoch
+    blockValue = np.where(secondsSinceStart < PPLNGSeconds, blockValue*(secondsSinceStart/PPLNGSeconds), blockValue)
+    return secondaryScale*blockValue, PrimaryScale*blockValue
+
+def compute_reward_coefficients_scalar(columns, startEpoch):
+    # Pure python version of compute_reward_coefficients, used when numpy is not installed
+    c29Coeffs = []
+    c31Coeffs = []
+    for index in range(0, len(columns["height"])):
+        secondaryScale = max(29, columns["secondary_scaling"][index])*2
+        poolValue = columns["pool_secondary_gps"][index]*secondaryScale + columns["pool_primary_gps"][index]*PrimaryScale
+        blockValue = (60+columns["fee"][index]*NanoGrin)*(1.0-PoolFee)/poolValue
+        secondsSinceStart = columns["timestamp"][index] - startEpoch
+        if secondsSinceStart < PPLNGSeconds:
+            blockValue = blockValue * (secondsSinceStart/PPLNGSeconds)
+        c29Coeffs.append(secondaryScale*blockValue)
+        c31Coeffs.append(PrimaryScale*blockValue)
+    return c29Coeffs, c31Coeffs
+
+def compute_rewards(columns, c29gps, c31gps, startEpoch):
+    # Calculate the theoretical miners reward for each block
+    c29Coeffs, c31Coeffs = compute_reward_coefficients(columns, startEpoch)
+    if np is None:
+        return [c29gps*c29Coeff + c31gps*c31Coeff for c29Coeff, c31Coeff in zip(c29Coeffs, c31Coeffs)]
+    return c29gps*c29Coeffs + c31gps*c31Coeffs
+
+def running_averages(timestamps, rewards, startEpoch):
+    # Average daily reward since startEpoch at each block, for blocks sorted by time
+    if np is None:
+        averages = []
+        rewardTotal = 0
+        for timestamp, minersReward in zip(timestamps, rewards):
+            rewardTotal += minersReward
+            averages.append(rewardTotal/((timestamp - startEpoch)/SecondsInDay))
+        return averages
+    secondsSinceStart = np.asarray(timestamps, dtype=np.float64) - startEpoch
+    return np.cumsum(rewards)/(secondsSinceStart/SecondsInDay)
 
-x.append(EndTS)
-y.append(rewardTotal/NumDays)
-print_footer(rewardTotal, C29Gps, C31Gps, NumDays, startTS, EndTS)
+def sum_reward_coefficients(columns, startEpoch):
+    # Sum of the per-block (c29Coeff, c31Coeff) over all blocks in the columns
+    c29Coeffs, c31Coeffs = compute_reward_coefficients(columns, startEpoch)
+    if np is None:
+        return sum(c29Coeffs), sum(c31Coeffs)
+    return float(np.sum(c29Coeffs)), float(np.sum(c31Coeffs))
 
-if Graph == True:
-    print("Generating graph...")
-    graphName = "Avg Daily Reward: {} Grin".format(round(rewardTotal/NumDays, 2))
-    graphData = [go.Scatter(x=x, y=y, name=graphName)]
+def sweep_rewards(coefficientTotals, scenarios):
+    # Total rewards for each (name, c29gps, c31gps) scenario, given the summed reward coefficients
+    c29Total, c31Total = coefficientTotals
+    if np is None:
+        return [c29gps*c29Total + c31gps*c31Total for name, c29gps, c31gps in scenarios]
+    c29gps = np.array([scenario[1] for scenario in scenarios], dtype=np.float64)
+    c31gps = np.array([scenario[2] for scenario in scenarios], dtype=np.float64)
+    return [float(total) for total in c29gps*c29Total + c31gps*c31Total]
+
+def parse_gps_list(value):
+    # Parse "1,2,5" or an inclusive range "start:stop:step" into a list of gps values
+    # Raises ValueError for a list with no values, so a sweep never falls back to a single estimate
+    if ":" in value:
+        start, stop, step = [float(part) for part in value.split(":")]
+        if step <= 0:
+            raise ValueError("step must be positive")
+        if stop < start:
+            raise ValueError("range {} stops before it starts".format(value))
+        count = int(round((stop - start) / step))
+        return [start + index*step for index in range(0, count+1)]
+    values = [float(part) for part in value.split(",") if part.strip() != ""]
+    if len(values) == 0:
+        raise ValueError("no gps values in {!r}".format(value))
+    return values
+
+def read_rigs(filename):
+    # Read (name, c29gps, c31gps) scenarios from a csv file with a name,c29gps,c31gps header
+    rigs = []
+    with open(filename, newline='') as rigsfile:
+        for row in csv.DictReader(rigsfile):
+            rigs.append((row['name'], float(row.get('c29gps') or 0), float(row.get('c31gps') or 0)))
+    return rigs
+
+def print_sweep(scenarios, totals, numDays, startTS, endTS):
+    print("  ")
+    print("  ")
+    print("   Report for {} days - from: {} to: {}".format(numDays, startTS.strftime("%m-%d-%y %H:%M"), endTS.strftime("%m-%d-%y %H:%M")))
+    print(" ")
+    print("   {:<20} {:>10} {:>10} {:>20} {:>20}".format("Scenario", "C29 gps", "C31 gps", "Total Rewards", "Avg Daily Reward"))
+    for (name, c29gps, c31gps), rewardTotal in zip(scenarios, totals):
+        print("   {:<20} {:>10} {:>10} {:>20.9f} {:>20.9f}".format(name, c29gps, c31gps, rewardTotal, rewardTotal/numDays))
+    print(" ")
+
+def write_sweep(filename, scenarios, totals, numDays):
+    with open(filename, "w", newline='') as sweepfile:
+        writer = csv.writer(sweepfile)
+        writer.writerow(["name", "c29gps", "c31gps", "total_rewards", "avg_daily_reward"])
+        for (name, c29gps, c31gps), rewardTotal in zip(scenarios, totals):
+            writer.writerow([name, c29gps, c31gps, rewardTotal, rewardTotal/numDays])
+
+
+def render_graph(result, filename):
+    import plotly
+    import plotly.graph_objs as go
+    graphName = "Avg Daily Reward: {} Grin".format(round(result.daily, 2))
+    graphData = [go.Scatter(x=result.x, y=result.y, name=graphName)]
     graphLayout = go.Layout(
         title=go.layout.Title(text=graphName),
         xaxis=go.layout.XAxis(
@@ -209,5 +596,399 @@ if Graph == True:
         ),
     )
     graphFigure = go.Figure(data=graphData, layout=graphLayout)
-    graph_name = "estimate-{}days.html".format(NumDays)
-    plotly.offline.plot(graphFigure, filename=graph_name)
+    plotly.offline.plot(graphFigure, filename=filename)
+
+def check_options(days, concurrency=1, page_size=PoolBlocksPageSize):
+    # Raise ValueError for options the estimator can not run with
+    if days <= 0:
+        raise ValueError("Number of days must be greater than 0")
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if page_size < 1:
+        raise ValueError("page size must be at least 1")
+
+def iter_block_column_pages(api, startEpoch, endEpoch, concurrency=1, bulk=False, cache=None,
+                            page_size=PoolBlocksPageSize, progress=None, debug=False, since_height=0,
+                            first_page_size=None):
+    # Yield the block columns for each page of pool-found-blocks in [startEpoch, endEpoch], newest page first.
+    # progress, if given, is called with the height of each block as its data arrives
+    blockCache = None if cache is None else BlockCache(cache, api.url)
+    try:
+        for poolblocks in iter_pool_block_pages(api, startEpoch, endEpoch, page_size, since_height, first_page_size):
+            debug and print("Pool Blocks found in page: {}".format(poolblocks))
+            with api.tracer.span("fetch page", "fetch", blocks=len(poolblocks)):
+                if blockCache is None:
+                    blockDataIter = iter_block_data(api, poolblocks, concurrency, bulk)
+                else:
+                    blockDataIter = iter_cached_block_data(api, poolblocks, blockCache, concurrency, bulk, debug)
+                columns = new_block_columns()
+                for blockHeight, (grinblockJSON, poolGpsJSON) in zip(poolblocks, blockDataIter):
+                    add_block_columns(columns, blockHeight, grinblockJSON, poolGpsJSON)
+                    if progress is not None:
+                        progress(blockHeight)
+            yield columns
+    finally:
+        if blockCache is not None:
+            blockCache.close()
+
+def estimate(days, c29gps, c31gps, url=mwURL, concurrency=1, bulk=False, cache=None,
+             page_size=PoolBlocksPageSize, max_requests=DefaultRequestBudget, end=None,
+             progress=None, debug=False, transport=None, tracer=None, series=False):
+    # Estimate the rewards for mining at c29gps/c31gps over the `days` before `end` (default: now).
+    # Returns an EstimateResult.  Raises RequestBudgetExceeded if more than max_requests (0 for
+    # no limit) API calls would be needed, and ValueError for invalid options.
+    # transport, an APITape, records or replays the API traffic; tracer, a Tracer, times it.
+    # With series the result has the average daily reward at every block, for the graph
+    check_options(days, concurrency, page_size)
+    api = PoolAPI(url, max_requests or None, transport, tracer)
+    endTS = datetime.now() if end is None else end
+    startTS = endTS - timedelta(days=days)
+    startEpoch = startTS.timestamp()
+    endEpoch = endTS.timestamp()
+    debug and print("Start Time: {} - {}".format(startTS, startEpoch))
+    debug and print("End Time:   {} - {}".format(endTS, endEpoch))
+
+    # The block data is dropped after each page.  Only the total is kept, or for the graph
+    # series, the per-block timestamp and reward
+    pageRewards = []
+    pageTotal = 0.0
+    blocks = 0
+    for columns in iter_block_column_pages(api, startEpoch, endEpoch, concurrency, bulk, cache, page_size, progress, debug):
+        #   Calculate theoretical miners rewards
+        with api.tracer.span("compute rewards", "compute", blocks=len(columns["height"])):
+            rewards = compute_rewards(columns, c29gps, c31gps, startEpoch)
+        for index, blockHeight in enumerate(columns["height"]):
+            debug and print("   + Miners reward for {} block {}: {}".format(epoch_to_dt(columns["timestamp"][index]).strftime('%c'), blockHeight, rewards[index]))
+        blocks += len(columns["height"])
+        if series:
+            pageRewards.append((columns["timestamp"], rewards))
+        elif np is None:
+            pageTotal += sum(rewards)
+        else:
+            pageTotal += float(np.sum(rewards))
+    debug and print("API requests: {}".format(api.count))
+    if not series:
+        return EstimateResult(days, c29gps, c31gps, startTS, endTS, pageTotal, pageTotal/days,
+                              blocks, api.count, None, None)
+
+    # Pages are newest first, blocks within a page oldest first
+    timestamps = []
+    rewards = []
+    for pageTimestamps, pageRewardValues in reversed(pageRewards):
+        timestamps += pageTimestamps
+        rewards += list(pageRewardValues)
+    with api.tracer.span("running averages", "compute", blocks=len(timestamps)):
+        averages = running_averages(timestamps, rewards, startEpoch)
+        rewardTotal = 0
+        x = [startTS]
+        y = [0]
+        for index in range(0, len(timestamps)):
+            rewardTotal += float(rewards[index])
+            x.append(epoch_to_dt(timestamps[index]))
+            y.append(float(averages[index]))
+    x.append(endTS)
+    y.append(rewardTotal/days)
+    return EstimateResult(days, c29gps, c31gps, startTS, endTS, rewardTotal, rewardTotal/days,
+                          len(timestamps), api.count, x, y)
+
+def sweep(days, scenarios, url=mwURL, concurrency=1, bulk=False, cache=None,
+          page_size=PoolBlocksPageSize, max_requests=DefaultRequestBudget, end=None,
+          progress=None, debug=False, transport=None, tracer=None):
+    # Estimate the rewards for each (name, c29gps, c31gps) scenario from a single pass over the
+    # block data.  Returns a SweepResult, raises like estimate()
+    check_options(days, concurrency, page_size)
+    api = PoolAPI(url, max_requests or None, transport, tracer)
+    endTS = datetime.now() if end is None else end
+    startTS = endTS - timedelta(days=days)
+    startEpoch = startTS.timestamp()
+    coefficientTotals = (0, 0)
+    blocks = 0
+    for columns in iter_block_column_pages(api, startEpoch, endTS.timestamp(), concurrency, bulk, cache, page_size, progress, debug):
+        with api.tracer.span("reward coefficients", "compute", blocks=len(columns["height"])):
+            pageTotals = sum_reward_coefficients(columns, startEpoch)
+        coefficientTotals = (coefficientTotals[0] + pageTotals[0], coefficientTotals[1] + pageTotals[1])
+        blocks += len(columns["height"])
+    debug and print("API requests: {}".format(api.count))
+    scenarios = list(scenarios)
+    with api.tracer.span("sweep scenarios", "compute", scenarios=len(scenarios)):
+        totals = sweep_rewards(coefficientTotals, scenarios)
+    return SweepResult(days, startTS, endTS, scenarios, totals, blocks, api.count)
+
+class RewardWindow:
+    # Sliding window of pool blocks, oldest first, with each block's full miners reward.
+    # The sum of the full rewards is kept as blocks are added and expired; only the blocks in the
+    # first PPLNG period of the window, which get a pro-rated reward, are visited on each update
+    def __init__(self):
+        self.blocks = deque()  # (height, timestamp, fullReward)
+        self.fullTotal = 0.0
+        self.updates = 0
+
+    def last_height(self):
+        return self.blocks[-1][0] if len(self.blocks) > 0 else 0
+
+    # Add blocks from a columns page, which must be newer than the blocks already in the window
+    def add(self, columns, c29gps, c31gps):
+        # With no start time every block gets its full reward
+        fullRewards = compute_rewards(columns, c29gps, c31gps, float("-inf"))
+        for index, blockHeight in enumerate(columns["height"]):
+            fullReward = float(fullRewards[index])
+            self.blocks.append((blockHeight, columns["timestamp"][index], fullReward))
+            self.fullTotal += fullReward
+        return len(columns["height"])
+
+    # Drop blocks found before startEpoch
+    def expire(self, startEpoch):
+        expired = 0
+        while len(self.blocks) > 0 and self.blocks[0][1] < startEpoch:
+            self.fullTotal -= self.blocks.popleft()[2]
+            expired += 1
+        self.updates += 1
+        if self.updates % WatchResyncEvery == 0:
+            self.fullTotal = sum(block[2] for block in self.blocks)
+        return expired
+
+    # Total reward over the window starting at startEpoch
+    def total(self, startEpoch):
+        total = self.fullTotal
+        for blockHeight, timestamp, fullReward in self.blocks:
+            secondsSinceStart = timestamp - startEpoch
+            if secondsSinceStart >= PPLNGSeconds:
+                break
+            total -= fullReward * (1.0 - secondsSinceStart/PPLNGSeconds)
+        return total
+
+def watch(days, c29gps, c31gps, interval=60, url=mwURL, concurrency=1, bulk=False, cache=None,
+          page_size=PoolBlocksPageSize, max_requests=DefaultRequestBudget, progress=None,
+          debug=False, transport=None, updates=None, tracer=None):
+    # Keep a running estimate over the last `days`, yielding a WatchUpdate every `interval` seconds.
+    # The first update loads the whole window; later ones only fetch the newly found pool blocks,
+    # starting with a small page.  max_requests applies to each update.  An update that fails on a
+    # request is yielded with its error, and the next one retries from the same window.
+    # Runs forever unless `updates` limits the number of updates
+    check_options(days, concurrency, page_size)
+    api = PoolAPI(url, max_requests or None, transport, tracer)
+    window = RewardWindow()
+    count = 0
+    while updates is None or count < updates:
+        if count > 0:
+            time.sleep(interval)
+        api.count = 0
+        nowTS = datetime.now()
+        startEpoch = (nowTS - timedelta(days=days)).timestamp()
+        newBlocks = 0
+        pages = []
+        sinceHeight = window.last_height()
+        try:
+            for columns in iter_block_column_pages(api, startEpoch, float("inf"), concurrency, bulk, cache,
+                                                   page_size, progress, debug, sinceHeight,
+                                                   WatchFirstPageSize if sinceHeight > 0 else None):
+                pages.append(columns)
+        except (RequestBudgetExceeded, OSError, ValueError) as e:
+            # requests errors are OSErrors, and a response that is not json a ValueError.
+            # The window only changes once every page is in, so it is still whole
+            debug and print("Update failed: {}: {}".format(type(e).__name__, e))
+            yield WatchUpdate(nowTS, epoch_to_dt(startEpoch), None, None, len(window.blocks), 0, 0, api.count, str(e))
+            count += 1
+            continue
+        # Pages are newest first
+        with api.tracer.span("update window", "compute"):
+            for columns in reversed(pages):
+                newBlocks += window.add(columns, c29gps, c31gps)
+            expired = window.expire(startEpoch)
+            total = window.total(startEpoch)
+        debug and print("Window: {} blocks, {} new, {} expired, {} API requests".format(len(window.blocks), newBlocks, expired, api.count))
+        yield WatchUpdate(nowTS, epoch_to_dt(startEpoch), total, total/days, len(window.blocks), newBlocks, expired, api.count, None)
+        count += 1
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", help="Number of days to average over")
+    parser.add_argument("--c29gps", help="Miners C29 Graphs/second")
+    parser.add_argument("--c31gps", help="Miners C31 Graphs/second")
+    parser.add_argument("--c29-grid", help="Sweep a list of C29 gps values: 1,2,5 or start:stop:step")
+    parser.add_argument("--c31-grid", help="Sweep a list of C31 gps values: 1,2,5 or start:stop:step")
+    parser.add_argument("--rigs", help="Sweep the rigs in a csv file with columns name,c29gps,c31gps")
+    parser.add_argument("--sweep-output", help="Write the sweep results to this csv file")
+    parser.add_argument("--concurrency", help="Number of API requests to run in parallel (default: 1)", type=int, default=1)
+    parser.add_argument("--bulk", help="Load block data with paged range requests instead of one request per block", action='store_true')
+    parser.add_argument("--page-size", help="Number of pool blocks to request per page of history (default: {})".format(PoolBlocksPageSize), type=int, default=PoolBlocksPageSize)
+    parser.add_argument("--max-requests", help="Max number of pool API requests to make (default: {}, 0 for no limit)".format(DefaultRequestBudget), type=int, default=DefaultRequestBudget)
+    parser.add_argument("--cache", help="sqlite file used to cache block data between runs")
+    parser.add_argument("--watch", help="Keep running, and update the estimate every WATCH seconds", type=float)
+    parser.add_argument("--record", help="Record all pool API traffic to this file")
+    parser.add_argument("--replay", help="Replay pool API traffic from a file made with --record, instead of using the network")
+    parser.add_argument("--trace", help="Write a timed span for every API request and phase of the run to this file")
+    parser.add_argument("--trace-format", help="Format of the --trace file: jsonl or chrome (default: jsonl)", choices=["jsonl", "chrome"], default="jsonl")
+    parser.add_argument("--profile", help="Print a summary of where the time went", action='store_true')
+    parser.add_argument("--end", help="End of the report as a unix timestamp (default: now), useful with --replay")
+    parser.add_argument("--debug", help="Print lots of debug info", action='store_true')
+    parser.add_argument("--no-graph", help="Dont generate graph", action='store_false', dest='Graph')
+    args = parser.parse_args()
+
+    Graph = bool(args.Graph) and graph_available()
+    debug = bool(args.debug)
+
+    print_header(bool(args.Graph))
+
+    if args.record is not None and args.replay is not None:
+        print("   -- Error: --record and --replay can not be used together")
+        sys.exit(1)
+
+    if args.replay is None and importlib.util.find_spec("requests") is None:
+        print("Error:  This script requires the 'requests' module, please run `pip3 install requests`")
+        sys.exit(1)
+
+    if args.days is None:
+        NumDays = float(input("   Number of days to average over: "))
+    else:
+        NumDays = float(args.days)
+
+    try:
+        check_options(NumDays, args.concurrency, args.page_size)
+    except ValueError as e:
+        print(" ")
+        print("   -- Error: {}".format(e))
+        print(" ")
+        sys.exit(1)
+
+    # Build the list of (name, c29gps, c31gps) scenarios to sweep, if any
+    Scenarios = []
+    try:
+        if args.c29_grid is not None or args.c31_grid is not None:
+            c29Grid = parse_gps_list(args.c29_grid if args.c29_grid is not None else (args.c29gps or "0"))
+            c31Grid = parse_gps_list(args.c31_grid if args.c31_grid is not None else (args.c31gps or "0"))
+            Scenarios += [("grid", c29gps, c31gps) for c29gps in c29Grid for c31gps in c31Grid]
+        if args.rigs is not None:
+            Scenarios += read_rigs(args.rigs)
+    except Exception as e:
+        print(" ")
+        print("   -- Error: Invalid sweep scenarios: {}".format(e))
+        print(" ")
+        sys.exit(1)
+
+    if len(Scenarios) == 0:
+        if args.c29gps is None:
+            C29Gps = float(input("   Miners C29 Graphs/second: "))
+        else:
+            C29Gps = float(args.c29gps)
+
+        if args.c31gps is None:
+            C31Gps = float(input("   Miners C31 Graphs/second: "))
+        else:
+            C31Gps = float(args.c31gps)
+
+    dotsWritten = [False]
+    def progress(blockHeight):
+        # Status
+        debug or sys.stdout.write(".")
+        sys.stdout.flush()
+        dotsWritten[0] = True
+
+    options = dict(
+        concurrency = args.concurrency,
+        bulk = args.bulk,
+        cache = args.cache,
+        page_size = args.page_size,
+        max_requests = args.max_requests,
+        progress = progress,
+        debug = debug,
+    )
+    if args.end is not None:
+        options["end"] = epoch_to_dt(float(args.end))
+    Trace = Tracer(args.trace is not None or args.profile)
+    options["tracer"] = Trace
+
+    Tape = None
+    try:
+        if args.record is not None:
+            Tape = APITape(args.record, "record")
+        elif args.replay is not None:
+            Tape = APITape(args.replay, "replay")
+    except Exception as e:
+        print(" ")
+        print("   -- Error: Could not open tape file: {}".format(e))
+        print(" ")
+        sys.exit(1)
+    options["transport"] = Tape
+
+    print(" ")
+    print("   Getting Mining Data: ")
+    debug or sys.stdout.write("   ")
+    sys.stdout.flush()
+    try:
+        if args.watch is not None:
+            if len(Scenarios) > 0:
+                raise ValueError("--watch can not be used with a sweep")
+            options.pop("end", None)
+            print(" ")
+            print("   Mining C29 at {}gps, C31 at {}gps over the last {} days, updating every {}s".format(C29Gps, C31Gps, NumDays, args.watch))
+            for update in watch(NumDays, C29Gps, C31Gps, args.watch, **options):
+                if dotsWritten[0]:
+                    print(" ")
+                    dotsWritten[0] = False
+                if update.error is not None:
+                    print("   {}  -- Error: {}.  Retrying in {}s".format(update.time.strftime("%m-%d-%y %H:%M:%S"), update.error, args.watch))
+                    sys.stdout.flush()
+                    continue
+                print("   {}  blocks: {} (+{} -{})  Total Rewards: {} Grin  Avg Daily Reward: {} Grin".format(
+                    update.time.strftime("%m-%d-%y %H:%M:%S"), update.blocks, update.new_blocks, update.expired_blocks, update.total, update.daily))
+                sys.stdout.flush()
+        elif len(Scenarios) > 0:
+            result = sweep(NumDays, Scenarios, **options)
+        else:
+            result = estimate(NumDays, C29Gps, C31Gps, series=Graph, **options)
+    except RequestBudgetExceeded as e:
+        print(" ")
+        print(" ")
+        print("   -- Error: {}.  Use --bulk and/or --cache to reduce the number of requests, or raise --max-requests".format(e))
+        print(" ")
+        sys.exit(1)
+    except TapeMiss as e:
+        print(" ")
+        print(" ")
+        print("   -- Error: {}.  Replay with the same options and --end that were recorded".format(e))
+        print(" ")
+        sys.exit(1)
+    except ValueError as e:
+        print(" ")
+        print("   -- Error: {}".format(e))
+        print(" ")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print(" ")
+        sys.exit(0)
+    finally:
+        if Tape is not None:
+            Tape.close()
+        if args.watch is not None:
+            finish_trace(Trace, args)
+
+    if len(Scenarios) > 0:
+        print_sweep(result.scenarios, result.totals, NumDays, result.start, result.end)
+        if args.sweep_output is not None:
+            write_sweep(args.sweep_output, result.scenarios, result.totals, NumDays)
+            print("   Sweep results written to: {}".format(args.sweep_output))
+            print(" ")
+        finish_trace(Trace, args)
+        return
+
+    print_footer(result.total, C29Gps, C31Gps, NumDays, result.start, result.end)
+
+    if Graph == True:
+        print("Generating graph...")
+        graph_name = "estimate-{}days.html".format(NumDays)
+        with Trace.span("render graph", "render", blocks=result.blocks):
+            render_graph(result, graph_name)
+    finish_trace(Trace, args)
+
+def finish_trace(tracer, args):
+    if args.profile:
+        tracer.print_profile()
+    if args.trace is not None:
+        tracer.write(args.trace, args.trace_format)
+        print("   Trace written to: {}".format(args.trace))
+        print(" ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+
+# Copyright 2018 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# ------------------------------------------------------------------------
+
+###
+# Benchmark MWGP_earningsEstimate.py against a local stand-in for the pool API
+# Input: --blocks, --latency, --strategies
+
+# Algorithm:
+#   Start a local http server that serves a synthetic pool history with the same endpoints
+#   as the pool API, sleeping --latency ms on every request
+#   For each dataset size and fetch strategy:
+#       Run the estimator in a child process (so peak memory is measured per run)
+#       Record wall time, number of API requests and peak memory
+#   Print a table, and optionally write the results as json for before/after comparisons
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BlockSeconds = 60
+PoolBlockEvery = 3  # The synthetic pool finds every 3rd grin block
+TipHeight = 1000000
+
+# Fetch strategies: name -> estimator options
+Strategies = {
+    "serial": {"concurrency": 1},
+    "concurrent": {"concurrency": 16},
+    "bulk": {"bulk": True},
+    "bulk-concurrent": {"bulk": True, "concurrency": 4},
+    "cached": {"bulk": True, "cache": True},
+}
+
+##
+# Synthetic pool history.  Every value is derived from the height, so any size of dataset
+# can be served without holding it in memory
+
+class SyntheticPool:
+    def __init__(self, numBlocks, tipTimestamp):
+        self.numBlocks = numBlocks
+        self.tipTimestamp = tipTimestamp
+        self.oldestPoolHeight = TipHeight - (numBlocks-1)*PoolBlockEvery
+
+    def days(self):
+        # Number of days that covers the whole dataset
+        return (self.numBlocks*PoolBlockEvery*BlockSeconds + 3600) / float(60*60*24)
+
+    def timestamp(self, height):
+        return self.tipTimestamp - (TipHeight-height)*BlockSeconds
+
+    def grin_block(self, height):
+        return {
+            "height": height,
+            "timestamp": self.timestamp(height),
+            "secondary_scaling": 20 + (height*7919) % 900,
+            "fee": (height*104729) % 50000000,
+        }
+
+    def pool_stat(self, height):
+        return {
+            "height": height,
+            "gps": [
+                {"edge_bits": 29, "gps": 1000.0 + (height*31) % 4000},
+                {"edge_bits": 31, "gps": 10.0 + (height*17) % 40},
+            ],
+        }
+
+    def pool_blocks(self, height, count):
+        # Up to count pool blocks at or below height, newest first
+        if height == 0 or height > TipHeight:
+            height = TipHeight
+        top = TipHeight - ((TipHeight-height + PoolBlockEvery-1)//PoolBlockEvery)*PoolBlockEvery
+        blocks = []
+        for poolHeight in range(top, self.oldestPoolHeight-1, -PoolBlockEvery)[:count]:
+            blocks.append({"height": poolHeight, "timestamp": self.timestamp(poolHeight)})
+        return blocks
+
+    def heights(self, height, count):
+        return range(max(height-count+1, 1), min(height, TipHeight)+1)
+
+##
+# Local http stand-in for the pool API
+
+class PoolAPIHandler(BaseHTTPRequestHandler):
+    routes = [
+        (re.compile(r"^/pool/blocks/(\d+),(\d+)(/.*)?$"), lambda pool, h, n: pool.pool_blocks(h, n)),
+        (re.compile(r"^/grin/blocks/(\d+),(\d+)(/.*)?$"), lambda pool, h, n: [pool.grin_block(x) for x in pool.heights(h, n)]),
+        (re.compile(r"^/pool/stats/(\d+),(\d+)(/.*)?$"), lambda pool, h, n: [pool.pool_stat(x) for x in pool.heights(h, n)]),
+        (re.compile(r"^/grin/block/(\d+)(/.*)?$"), lambda pool, h: pool.grin_block(h)),
+        (re.compile(r"^/pool/stat/(\d+)(/.*)?$"), lambda pool, h: pool.pool_stat(h)),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        if server.latency > 0:
+            time.sleep(server.latency)
+        for pattern, handler in self.routes:
+            match = pattern.match(self.path)
+            if match is not None:
+                params = [int(group) for group in match.groups() if group is not None and not group.startswith("/")]
+                body = json.dumps(handler(server.pool, *params)).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_error(404)
+
+class PoolAPIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, pool, latency=0.0):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), PoolAPIHandler)
+        self.pool = pool
+        self.latency = latency
+        self.request_count = 0
+        self.lock = threading.Lock()
+
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def take_count(self):
+        with self.lock:
+            count = self.request_count
+            self.request_count = 0
+        return count
+
+##
+# A single estimator run, in a child process
+
+def run_one(url, days, end, options):
+    import resource
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import MWGP_earningsEstimate
+    startTime = time.time()
+    result = MWGP_earningsEstimate.estimate(days, 2.0, 0.5, url=url, end=MWGP_earningsEstimate.epoch_to_dt(end),
+                                            max_requests=0, **options)
+    wallTime = time.time() - startTime
+    peakKB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peakKB = peakKB / 1024
+    print(json.dumps({"wall": wallTime, "blocks": result.blocks, "total": result.total, "peak_kb": peakKB}))
+
+def run_child(url, days, end, options):
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-one", json.dumps([url, days, end, options])]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.decode("utf-8").strip().split("\n")[-1])
+
+def run_benchmark(numBlocks, latency, strategies, workdir):
+    results = []
+    end = time.time()
+    pool = SyntheticPool(numBlocks, int(end) - 30)
+    server = PoolAPIServer(pool, latency)
+    server.start()
+    try:
+        for name in strategies:
+            options = dict(Strategies[name])
+            if options.pop("cache", False):
+                options["cache"] = os.path.join(workdir, "cache-{}.sqlite".format(numBlocks))
+                # Warm the cache, only the warm run is measured
+                run_child(server.url(), pool.days(), end, options)
+                server.take_count()
+            run = run_child(server.url(), pool.days(), end, options)
+            run.update({"strategy": name, "dataset": numBlocks, "latency_ms": latency*1000, "requests": server.take_count()})
+            results.append(run)
+            print_result(run)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def print_table_header():
+    print(" ")
+    print("   {:>9} {:<16} {:>10} {:>10} {:>12} {:>10}".format("Blocks", "Strategy", "Wall (s)", "Requests", "Peak (MB)", "Blocks/s"))
+
+def print_result(run):
+    print("   {:>9} {:<16} {:>10.2f} {:>10} {:>12.1f} {:>10.0f}".format(
+        run["dataset"], run["strategy"], run["wall"], run["requests"], run["peak_kb"]/1024.0, run["blocks"]/max(run["wall"], 0.000001)))
+    sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", help="Comma separated dataset sizes, in pool blocks (default: 1000,10000)", default="1000,10000")
+    parser.add_argument("--latency", help="Latency added to every API request, in ms (default: 0)", type=float, default=0.0)
+    parser.add_argument("--strategies", help="Comma separated fetch strategies (default: all): {}".format(",".join(Strategies.keys())), default=",".join(Strategies.keys()))
+    parser.add_argument("--output", help="Write the results to this json file")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_one(*json.loads(args.run_one))
+        return
+
+    strategies = [name.strip() for name in args.strategies.split(",") if name.strip() != ""]
+    for name in strategies:
+        if name not in Strategies:
+            print("   -- Error: Unknown strategy: {}".format(name))
+            sys.exit(1)
+    sizes = [int(size) for size in args.blocks.split(",")]
+
+    print(" ")
+    print("############# MWGrinPool Earnings Estimate Benchmark #############")
+    print("## ")
+    print("   Latency per request: {}ms".format(args.latency))
+    print_table_header()
+    results = []
+    workdir = tempfile.mkdtemp(prefix="mwgp-bench-")
+    try:
+        for numBlocks in sizes:
+            results += run_benchmark(numBlocks, args.latency/1000.0, strategies, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(" ")
+
+    # Every strategy must produce the same estimate
+    for numBlocks in sizes:
+        totals = [run["total"] for run in results if run["dataset"] == numBlocks]
+        if len(totals) > 0 and max(totals) - min(totals) > 1e-9 * max(abs(max(totals)), 1.0):
+            print("   WARNING: strategies disagree on the total reward for {} blocks: {}".format(numBlocks, totals))
+
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print("   Results written to: {}".format(args.output))
+        print(" ")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+#!/usr/bin/python3
+
+# Copyright 2018 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# ------------------------------------------------------------------------
+
+###
+# Benchmark MWGP_payout.py end to end, without a live pool or real funds
+# Input: --methods, --payouts, --concurrency, --pool-latency, --wallet-latency, --baseline
+
+# Algorithm:
+#   Start local http stand-ins for the pool API, the Grin++ owner API and the grin-wallet
+#   owner/foreign APIs, and write fake grin-wallet and wallet713 executables to a temp dir.
+#   The stand-ins and fake wallets sleep --pool-latency / --wallet-latency ms per call
+#   For each payout method and concurrency:
+#       Run --payouts payouts in a child process, --concurrency at a time, each with its own
+#       Pool_Payout as in batch mode, and record the latency of each payout
+#   Print p50/p95 latency and throughput, optionally write the results as json, and with
+#   --baseline exit 1 if p50 or p95 latency is more than --tolerance worse than the baseline
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PoolPassword = "bench"
+WalletPassword = "bench"
+BalanceNanogrin = 2500000000
+
+##
+# Fake wallet executables.  Both sign a slate by adding "signed": true to it.
+# Environment: BENCH_WALLET_LATENCY (seconds per command), BENCH_WALLET_FAIL (a command
+# name, such as receive, to fail)
+
+FakeGrinWallet = r'''
+import os, sys, json, time
+latency = float(os.environ.get("BENCH_WALLET_LATENCY", "0"))
+fail = os.environ.get("BENCH_WALLET_FAIL")
+args = [arg for arg in sys.argv[1:] if arg != "--floonet"]
+password = None
+if args[:1] == ["-p"]:
+    password = args[1]
+    args = args[2:]
+time.sleep(latency)
+if password != PASSWORD:
+    print("Error: Invalid password")
+    sys.exit(1)
+if len(args) == 0 or args[0] == fail:
+    print("Error: {} failed".format(args[0] if args else "command"))
+    sys.exit(1)
+if args[0] == "info":
+    print("Wallet Summary Info - Account 'default'")
+    sys.exit(0)
+if args[0] == "receive":
+    slatefile = args[args.index("-i") + 1]
+    with open(slatefile) as f:
+        slate = json.load(f)
+    slate["signed"] = True
+    with open(slatefile + ".response", "w") as f:
+        json.dump(slate, f)
+    print("Response file {}.response generated".format(slatefile))
+    sys.exit(0)
+print("Error: unknown command {}".format(args[0]))
+sys.exit(1)
+'''
+
+FakeWallet713 = r'''
+import os, sys, json, time
+latency = float(os.environ.get("BENCH_WALLET_LATENCY", "0"))
+fail = os.environ.get("BENCH_WALLET_FAIL")
+out = sys.stdout
+time.sleep(latency)
+out.write("wallet713 benchmark stand-in\nPassword: ")
+out.flush()
+if sys.stdin.readline().strip() != PASSWORD:
+    out.write("Error: Invalid password\n")
+    out.flush()
+    sys.exit(1)
+out.write("wallet713> ")
+out.flush()
+for line in sys.stdin:
+    command = line.split()
+    if len(command) == 0:
+        continue
+    time.sleep(latency)
+    if command[0] == "exit":
+        sys.exit(0)
+    if command[0] == fail:
+        out.write("Error: {} failed\n".format(command[0]))
+    elif command[0] == "help":
+        out.write("Commands: help, receive, exit\n")
+    elif command[0] == "receive":
+        with open(command[1]) as f:
+            slate = json.load(f)
+        slate["signed"] = True
+        with open(command[1] + ".response", "w") as f:
+            json.dump(slate, f)
+        out.write("slate [{}] received\n".format(slate["id"]))
+    out.write("wallet713> ")
+    out.flush()
+'''
+
+def write_fake_wallets(bindir, walletprefix="grin"):
+    for name, source in [("{}-wallet".format(walletprefix), FakeGrinWallet), ("wallet713", FakeWallet713)]:
+        filename = os.path.join(bindir, name)
+        with open(filename, "w") as f:
+            f.write("#!{}\n".format(sys.executable))
+            f.write("PASSWORD = {}\n".format(json.dumps(WalletPassword)))
+            f.write(source)
+        os.chmod(filename, 0o755)
+
+##
+# Local http stand-ins.  Every server counts its requests and sleeps `latency` seconds on each
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, handler, latency=0.0):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def take_count(self):
+        with self.lock:
+            count = self.request_count
+            self.request_count = 0
+        return count
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real services
+    disable_nagle_algorithm = True  # Headers and body are separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def begin(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        if server.latency > 0:
+            time.sleep(server.latency)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length > 0 else b""
+
+    def reply(self, code, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class PoolAPIHandler(StandInHandler):
+    # /pool/users, /worker/utxo, get_tx_slate, submit_tx_slate and /pool/payment/http
+    def user_id(self):
+        try:
+            user, password = base64.b64decode(self.headers.get("Authorization", "")[6:]).decode("utf-8").split(":", 1)
+        except Exception:
+            return None
+        if password != PoolPassword:
+            return None
+        with self.server.lock:
+            return self.server.users.setdefault(user, len(self.server.users) + 1)
+
+    def do_GET(self):
+        self.begin()
+        user_id = self.user_id()
+        if user_id is None:
+            return self.reply(401, "Unauthorized")
+        if self.path == "/pool/users":
+            return self.reply(200, {"id": user_id})
+        if self.path == "/worker/utxo/{}".format(user_id):
+            return self.reply(200, {"amount": BalanceNanogrin})
+        self.reply(404, "Not found")
+
+    def do_POST(self):
+        body = self.begin()
+        user_id = self.user_id()
+        if user_id is None:
+            return self.reply(401, "Unauthorized")
+        if self.path == "/pool/payment/get_tx_slate/{}".format(user_id):
+            return self.reply(200, {"id": str(uuid.uuid4()), "amount": BalanceNanogrin, "participant_data": []})
+        if self.path == "/pool/payment/submit_tx_slate/{}".format(user_id):
+            try:
+                if json.loads(body.decode("utf-8")).get("signed") is not True:
+                    return self.reply(400, "Slate is not signed")
+            except Exception:
+                return self.reply(400, "Invalid slate")
+            return self.reply(200, "ok")
+        if self.path.startswith("/pool/payment/http/{}/".format(user_id)):
+            return self.reply(200, "ok")
+        self.reply(404, "Not found")
+
+class GrinppHandler(StandInHandler):
+    # Grin++ v1 owner API: login, retrieve_summary_info, receive_tx, logout
+    def token_ok(self):
+        with self.server.lock:
+            return self.headers.get("session_token") in self.server.users
+
+    def do_GET(self):
+        self.begin()
+        if self.path == "/v1/wallet/owner/retrieve_summary_info":
+            if not self.token_ok():
+                return self.reply(401, "Unauthorized")
+            return self.reply(200, {"total": BalanceNanogrin})
+        self.reply(404, "Not found")
+
+    def do_POST(self):
+        body = self.begin()
+        if self.path == "/v1/wallet/owner/login":
+            if self.headers.get("password") != WalletPassword:
+                return self.reply(401, "Invalid password")
+            token = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.users[token] = self.headers.get("username")
+            return self.reply(200, {"session_token": token})
+        if not self.token_ok():
+            return self.reply(401, "Unauthorized")
+        if self.path == "/v1/wallet/owner/logout":
+            with self.server.lock:
+                self.server.users.pop(self.headers.get("session_token"), None)
+            return self.reply(200, {})
+        if self.path == "/v1/wallet/owner/receive_tx":
+            slate = json.loads(body.decode("utf-8"))["slate"]
+            slate["signed"] = True
+            return self.reply(200, slate)
+        self.reply(404, "Not found")
+
+class WalletAPIHandler(StandInHandler):
+    # grin-wallet v2 owner and foreign JSON-RPC APIs: retrieve_summary_info and receive_tx
+    def do_POST(self):
+        request = json.loads(self.begin().decode("utf-8"))
+        if request["method"] == "retrieve_summary_info":
+            result = {"Ok": [True, {"total": str(BalanceNanogrin)}]}
+        elif request["method"] == "receive_tx":
+            slate = request["params"][0]
+            slate["signed"] = True
+            result = {"Ok": slate}
+        else:
+            return self.reply(200, {"jsonrpc": "2.0", "id": request["id"], "error": {"code": -32601, "message": "Method not found"}})
+        self.reply(200, {"jsonrpc": "2.0", "id": request["id"], "result": result})
+
+##
+# Payout methods: name -> commandline options for MWGP_payout.py.  {wallet_api} is replaced
+# by the url of the grin-wallet API stand-in
+
+Methods = {
+    "grin-wallet": ["--payout_method", "Grin Wallet", "--wallet_pass", WalletPassword],
+    "grin-wallet-api": ["--payout_method", "Grin Wallet API", "--wallet_api_url", "{wallet_api}/v2/owner",
+                        "--wallet_foreign_url", "{wallet_api}/v2/foreign"],
+    "grinplusplus": ["--payout_method", "Grin++ Wallet", "--wallet_user", "bench", "--wallet_pass", WalletPassword],
+    "wallet713": ["--payout_method", "Wallet713", "--wallet_pass", WalletPassword],
+    "http": ["--payout_method", "http/https", "--wallet_url", "http://127.0.0.1:1/bench"],
+}
+
+##
+# The payouts for one method and concurrency, in a child process
+
+def run_one(config):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import MWGP_payout
+    os.environ["PATH"] = config["bindir"] + os.pathsep + os.environ.get("PATH", "")
+    os.chdir(config["workdir"])
+    options = [option.format(wallet_api=config["wallet_api_url"]) for option in Methods[config["method"]]]
+
+    def payout(index):
+        # One payout, as batch mode runs it
+        p = MWGP_payout.Pool_Payout()
+        p.batch = True
+        p.out = io.StringIO()
+        p.mwURL = config["pool_url"]
+        p.grinplusplus_url = config["grinpp_url"]
+        p.args = p.make_parser().parse_args(options + [
+                "--pool_user", "bench-{}-{}".format(config["method"], index),
+                "--pool_pass", PoolPassword,
+                "--wallet_api_secret", os.path.join(config["workdir"], "no-api-secret"),
+                "--journal_dir", config["workdir"],
+                "--no_slate_files",
+            ])
+        p.payout_method = p.args.payout_method
+        p.username = p.args.pool_user
+        p.password = p.args.pool_pass
+        start = time.perf_counter()
+        error = None
+        try:
+            p.run_payout()
+        except MWGP_payout.Payout_Error as e:
+            error = str(e)
+        except Exception as e:
+            error = "Unexpected error: {}".format(str(e))
+        return time.perf_counter() - start, error
+
+    startTime = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=config["concurrency"]) as executor:
+        results = list(executor.map(payout, range(config["payouts"])))
+    wallTime = time.perf_counter() - startTime
+    MWGP_payout.Grinplusplus_Client.close_all()
+    print(json.dumps({
+            "wall": wallTime,
+            "latencies": [latency for latency, error in results if error is None],
+            "errors": [error for latency, error in results if error is not None],
+        }))
+
+def run_child(config):
+    cmd = [sys.executable, os.path.abspath(__file__), "--run-one", json.dumps(config)]
+    output = subprocess.check_output(cmd)
+    return json.loads(output.decode("utf-8").strip().split("\n")[-1])
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[max(int(round(fraction*len(values) + 0.5)) - 1, 0) if fraction < 1 else -1]
+
+def run_benchmark(methods, payouts, concurrencies, poolLatency, walletLatency, workdir):
+    bindir = os.path.join(workdir, "bin")
+    os.mkdir(bindir)
+    write_fake_wallets(bindir)
+    os.environ["BENCH_WALLET_LATENCY"] = str(walletLatency)
+    servers = {
+        "pool": StandInServer(PoolAPIHandler, poolLatency),
+        "grinpp": StandInServer(GrinppHandler, walletLatency),
+        "wallet_api": StandInServer(WalletAPIHandler, walletLatency),
+    }
+    for server in servers.values():
+        server.start()
+    results = []
+    try:
+        for method in methods:
+            for concurrency in concurrencies:
+                rundir = tempfile.mkdtemp(prefix="run-", dir=workdir)
+                config = {
+                    "method": method,
+                    "payouts": payouts,
+                    "concurrency": concurrency,
+                    "pool_url": servers["pool"].url(),
+                    "grinpp_url": servers["grinpp"].url(),
+                    "wallet_api_url": servers["wallet_api"].url(),
+                    "bindir": bindir,
+                    "workdir": rundir,
+                }
+                run = run_child(config)
+                latencies = run["latencies"]
+                result = {
+                    "method": method,
+                    "concurrency": concurrency,
+                    "payouts": payouts,
+                    "errors": len(run["errors"]),
+                    "p50_ms": percentile(latencies, 0.50)*1000,
+                    "p95_ms": percentile(latencies, 0.95)*1000,
+                    "max_ms": max(latencies)*1000 if len(latencies) > 0 else 0.0,
+                    "per_second": len(latencies)/max(run["wall"], 0.000001),
+                    "pool_requests": servers["pool"].take_count(),
+                    "pool_latency_ms": poolLatency*1000,
+                    "wallet_latency_ms": walletLatency*1000,
+                }
+                results.append(result)
+                print_result(result)
+                for error in sorted(set(run["errors"])):
+                    print("      error: {}".format(error))
+    finally:
+        for server in servers.values():
+            server.shutdown()
+            server.server_close()
+    return results
+
+def print_table_header():
+    print(" ")
+    print("   {:<16} {:>6} {:>8} {:>7} {:>10} {:>10} {:>10} {:>10} {:>9}".format(
+        "Method", "Conc", "Payouts", "Errors", "p50 (ms)", "p95 (ms)", "Max (ms)", "Payouts/s", "Pool req"))
+
+def print_result(result):
+    print("   {:<16} {:>6} {:>8} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} {:>9}".format(
+        result["method"], result["concurrency"], result["payouts"], result["errors"], result["p50_ms"],
+        result["p95_ms"], result["max_ms"], result["per_second"], result["pool_requests"]))
+    sys.stdout.flush()
+
+# Results that are slower than the baseline by more than tolerance, as messages
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    base = {(result["method"], result["concurrency"]): result for result in baseline}
+    for result in results:
+        before = base.get((result["method"], result["concurrency"]))
+        if before is None:
+            continue
+        for metric in ["p50_ms", "p95_ms"]:
+            if result[metric] > before[metric]*(1.0 + tolerance):
+                regressions.append("{} at concurrency {}: {} {:.1f}ms, baseline {:.1f}ms".format(
+                    result["method"], result["concurrency"], metric[:3], result[metric], before[metric]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--methods", help="Comma separated payout methods (default: all): {}".format(",".join(Methods.keys())), default=",".join(Methods.keys()))
+    parser.add_argument("--payouts", help="Number of payouts per method and concurrency (default: 20)", type=int, default=20)
+    parser.add_argument("--concurrency", help="Comma separated numbers of payouts to run at once (default: 1,8)", default="1,8")
+    parser.add_argument("--pool-latency", help="Latency added to every pool API request, in ms (default: 0)", type=float, default=0.0)
+    parser.add_argument("--wallet-latency", help="Latency added to every wallet command and wallet API request, in ms (default: 0)", type=float, default=0.0)
+    parser.add_argument("--output", help="Write the results to this json file")
+    parser.add_argument("--baseline", help="Compare with the results in this json file (from --output), and exit 1 on a regression")
+    parser.add_argument("--tolerance", help="Allowed p50/p95 slowdown against --baseline, as a fraction (default: 0.2)", type=float, default=0.2)
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        run_one(json.loads(args.run_one))
+        return
+
+    methods = [name.strip() for name in args.methods.split(",") if name.strip() != ""]
+    for name in methods:
+        if name not in Methods:
+            print("   -- Error: Unknown payout method: {}".format(name))
+            sys.exit(1)
+    concurrencies = [int(value) for value in args.concurrency.split(",")]
+    if args.payouts < 1 or min(concurrencies) < 1:
+        print("   -- Error: --payouts and --concurrency must be at least 1")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline is not None:
+        try:
+            with open(args.baseline) as baselinefile:
+                baseline = json.load(baselinefile)
+        except (OSError, ValueError) as e:
+            print("   -- Error: Could not read baseline: {}".format(e))
+            sys.exit(1)
+
+    print(" ")
+    print("############# MWGrinPool Payout Benchmark #############")
+    print("## ")
+    print("   Latency per pool request: {}ms, per wallet call: {}ms".format(args.pool_latency, args.wallet_latency))
+    print_table_header()
+    workdir = tempfile.mkdtemp(prefix="mwgp-payout-bench-")
+    try:
+        results = run_benchmark(methods, args.payouts, concurrencies, args.pool_latency/1000.0, args.wallet_latency/1000.0, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(" ")
+
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+        print("   Results written to: {}".format(args.output))
+        print(" ")
+
+    failed = False
+    if any(result["errors"] > 0 for result in results):
+        print("   FAILED: some payouts failed")
+        failed = True
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("   REGRESSION: {}".format(regression))
+        if len(regressions) == 0:
+            print("   No regressions against {} (tolerance {:.0%})".format(args.baseline, args.tolerance))
+        failed = failed or len(regressions) > 0
+    print(" ")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
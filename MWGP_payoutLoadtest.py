@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+
+# Copyright 2018 Blade M. Doyle
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# ------------------------------------------------------------------------
+
+###
+# Load test the pool payment API with many miners requesting payouts at once
+# Input: --url, --users, --rates, --duration, --pool-pass, --retries
+
+# Algorithm:
+#   Start --users virtual users, each a Pool_Payout for a synthetic account (loadtest-N)
+#   with its own keep-alive connection to the pool API
+#   For each target rate (payouts per second):
+#       Schedule payouts evenly over --duration seconds.  The next free virtual user runs
+#       each payout with Pool_Payout's own requests:
+#           get_user_id -> get_balance -> get_unsigned_slate -> return_payment_slate
+#       The slate is signed by marking it "signed", which the benchmark stand-in accepts
+#       Record the latency and result of every request, per endpoint
+#   Print the throughput at each rate, per endpoint latency histograms and error rates,
+#   and optionally write everything as json
+#   Without --url, the pool API stand-in from MWGP_payoutBenchmark.py is started locally
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import threading
+
+Endpoints = ["users", "utxo", "get_tx_slate", "submit_tx_slate"]
+
+# Latency histogram bucket upper bounds, in ms.  The last bucket is everything slower
+HistogramBuckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+##
+# Latencies and errors of one endpoint at one rate
+
+class EndpointStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.error_messages = {}
+
+    def add(self, latency, error):
+        self.latencies.append(latency)
+        if error is not None:
+            self.errors += 1
+            # Keep the first line only, so errors from different accounts group together
+            message = error.split("\n")[0][:120]
+            self.error_messages[message] = self.error_messages.get(message, 0) + 1
+
+    def percentile(self, fraction):
+        # Nearest-rank percentile, in ms
+        if len(self.latencies) == 0:
+            return 0.0
+        values = sorted(self.latencies)
+        return values[min(max(int(math.ceil(fraction*len(values))) - 1, 0), len(values)-1)] * 1000
+
+    def histogram(self):
+        counts = [0] * (len(HistogramBuckets) + 1)
+        for latency in self.latencies:
+            ms = latency * 1000
+            index = 0
+            while index < len(HistogramBuckets) and ms > HistogramBuckets[index]:
+                index += 1
+            counts[index] += 1
+        return counts
+
+    def summary(self):
+        return {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "error_rate": self.errors / float(max(len(self.latencies), 1)),
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "histogram": self.histogram(),
+            "error_messages": self.error_messages,
+        }
+
+##
+# A virtual user: one Pool_Payout for a synthetic account, reused for every payout it runs
+
+class VirtualUser:
+    def __init__(self, MWGP_payout, url, username, password, timeout, retries):
+        self.MWGP_payout = MWGP_payout
+        self.payout = MWGP_payout.Pool_Payout()
+        self.payout.batch = True
+        self.payout.out = io.StringIO()
+        self.payout.mwURL = url
+        self.payout.username = username
+        self.payout.password = password
+        self.payout.pool_timeout = timeout
+        self.payout.pool_http = MWGP_payout.Pool_API_Session(timeout, retries=retries)
+
+    def sign(self):
+        # Stand-in signer, no wallet is involved
+        try:
+            slate = json.loads(self.payout.unsigned_slate)
+            slate["signed"] = True
+            self.payout.signed_slate = json.dumps(slate)
+        except Exception as e:
+            return "Invalid payment slate from the pool: {}".format(str(e))
+
+    def call(self, stats, endpoint, request):
+        start = time.perf_counter()
+        try:
+            error = request()
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, str(e))
+        stats[endpoint].add(time.perf_counter() - start, error)
+        return error
+
+    # One payout.  Returns True if every request succeeded
+    def run_payout(self, stats):
+        p = self.payout
+        p.user_id = None
+        p.unsigned_slate = None
+        p.signed_slate = None
+        if self.call(stats, "users", p.get_user_id) is not None:
+            return False
+        if self.call(stats, "utxo", p.get_balance) is not None:
+            return False
+        if self.call(stats, "get_tx_slate", p.get_unsigned_slate) is not None:
+            return False
+        message = self.sign()
+        if message is not None:
+            stats["submit_tx_slate"].add(0.0, message)
+            return False
+        return self.call(stats, "submit_tx_slate", p.return_payment_slate) is None
+
+    def close(self):
+        self.payout.pool_http.close()
+
+##
+# Run payouts at one target rate for duration seconds
+
+def run_rate(users, rate, duration):
+    stats = {endpoint: EndpointStats() for endpoint in Endpoints}
+    scheduled = int(rate * duration)
+    lock = threading.Lock()
+    state = {"next": 0, "ok": 0, "failed": 0, "lag": 0.0}
+    start = time.perf_counter()
+
+    def worker(user):
+        while True:
+            with lock:
+                index = state["next"]
+                state["next"] += 1
+            if index >= scheduled:
+                return
+            # Open loop: each payout starts at its scheduled time, or as soon as a virtual
+            # user is free if they are all busy
+            delay = start + index/float(rate) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            ok = user.run_payout(stats)
+            with lock:
+                state["ok" if ok else "failed"] += 1
+                state["lag"] = max(state["lag"], -delay)
+
+    threads = [threading.Thread(target=worker, args=(user,), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wallTime = time.perf_counter() - start
+    return {
+        "rate": rate,
+        "duration": duration,
+        "scheduled": scheduled,
+        "ok": state["ok"],
+        "failed": state["failed"],
+        "wall": wallTime,
+        "per_second": state["ok"] / max(wallTime, 0.000001),
+        "max_lag_ms": state["lag"] * 1000,
+        "endpoints": {endpoint: stats[endpoint].summary() for endpoint in Endpoints},
+    }
+
+def print_throughput_header():
+    print(" ")
+    print("   {:>10} {:>10} {:>8} {:>8} {:>12} {:>14}".format("Rate (/s)", "Payouts/s", "OK", "Failed", "Wall (s)", "Max lag (ms)"))
+
+def print_throughput(step):
+    print("   {:>10.1f} {:>10.1f} {:>8} {:>8} {:>12.2f} {:>14.1f}".format(
+        step["rate"], step["per_second"], step["ok"], step["failed"], step["wall"], step["max_lag_ms"]))
+    sys.stdout.flush()
+
+def print_endpoints(step):
+    print(" ")
+    print("   ** At {:.1f} payouts/s".format(step["rate"]))
+    print("   {:<16} {:>9} {:>8} {:>8} {:>10} {:>10} {:>10}".format("Endpoint", "Requests", "Errors", "Error %", "p50 (ms)", "p95 (ms)", "p99 (ms)"))
+    for endpoint in Endpoints:
+        summary = step["endpoints"][endpoint]
+        print("   {:<16} {:>9} {:>8} {:>8.1f} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            endpoint, summary["requests"], summary["errors"], summary["error_rate"]*100,
+            summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]))
+    for endpoint in Endpoints:
+        for message, count in sorted(step["endpoints"][endpoint]["error_messages"].items()):
+            print("      {} error x{}: {}".format(endpoint, count, message))
+
+def print_histograms(step):
+    labels = ["<= {}ms".format(bound) for bound in HistogramBuckets] + ["> {}ms".format(HistogramBuckets[-1])]
+    for endpoint in Endpoints:
+        counts = step["endpoints"][endpoint]["histogram"]
+        if sum(counts) == 0:
+            continue
+        print(" ")
+        print("   {} latency at {:.1f} payouts/s".format(endpoint, step["rate"]))
+        # Only the buckets from the first to the last one used
+        used = [index for index, count in enumerate(counts) if count > 0]
+        for index in range(used[0], used[-1]+1):
+            bar = "#" * int(math.ceil(40.0 * counts[index] / max(counts)))
+            print("   {:>10} {:>7} {}".format(labels[index], counts[index], bar))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="Base url of the pool API to load (default: start a local stand-in)")
+    parser.add_argument("--users", help="Number of concurrent virtual users (default: 16)", type=int, default=16)
+    parser.add_argument("--rates", help="Comma separated target rates, in payouts per second (default: 5,10,20,40)", default="5,10,20,40")
+    parser.add_argument("--duration", help="Seconds to run each rate for (default: 10)", type=float, default=10.0)
+    parser.add_argument("--user-prefix", help="Synthetic accounts are named <prefix>-N (default: loadtest)", default="loadtest")
+    parser.add_argument("--pool-pass", help="Password of the synthetic accounts (default: the stand-in password)")
+    parser.add_argument("--timeout", help="Seconds to wait for each request (default: 30)", type=float, default=30.0)
+    parser.add_argument("--retries", help="Retries of failed GET requests (default: 0, so errors are not hidden)", type=int, default=0)
+    parser.add_argument("--pool-latency", help="Latency added to every request by the local stand-in, in ms (default: 0)", type=float, default=0.0)
+    parser.add_argument("--histograms", help="Print latency histograms for every rate, not just the last", action="store_true")
+    parser.add_argument("--output", help="Write the results to this json file")
+    args = parser.parse_args()
+
+    rates = [float(rate) for rate in args.rates.split(",") if rate.strip() != ""]
+    if args.users < 1 or args.duration <= 0 or len(rates) == 0 or min(rates) <= 0:
+        print("   -- Error: --users, --duration and --rates must be positive")
+        sys.exit(1)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import MWGP_payout
+    import MWGP_payoutBenchmark
+
+    server = None
+    url = args.url
+    password = args.pool_pass
+    if url is None:
+        server = MWGP_payoutBenchmark.StandInServer(MWGP_payoutBenchmark.PoolAPIHandler, args.pool_latency/1000.0)
+        server.start()
+        url = server.url()
+        if password is None:
+            password = MWGP_payoutBenchmark.PoolPassword
+    if password is None:
+        print("   -- Error: --pool-pass is required with --url")
+        sys.exit(1)
+    url = url.rstrip("/")
+
+    print(" ")
+    print("############# MWGrinPool Payment API Load Test #############")
+    print("## ")
+    print("   Pool API: {}{}".format(url, " (local stand-in)" if server is not None else ""))
+    print("   Virtual users: {}, {}s per rate".format(args.users, args.duration))
+    users = [VirtualUser(MWGP_payout, url, "{}-{}".format(args.user_prefix, index), password, args.timeout, args.retries)
+             for index in range(args.users)]
+    steps = []
+    try:
+        print_throughput_header()
+        for rate in rates:
+            step = run_rate(users, rate, args.duration)
+            steps.append(step)
+            print_throughput(step)
+    finally:
+        for user in users:
+            user.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    for step in steps:
+        print_endpoints(step)
+    for step in steps if args.histograms else steps[-1:]:
+        print_histograms(step)
+    print(" ")
+
+    if args.output is not None:
+        with open(args.output, "w") as outfile:
+            json.dump({
+                "url": url,
+                "users": args.users,
+                "histogram_buckets_ms": HistogramBuckets,
+                "steps": steps,
+            }, outfile, indent=2)
+        print("   Results written to: {}".format(args.output))
+        print(" ")
+
+
+if __name__ == "__main__":
+    main()